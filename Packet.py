@@ -6,23 +6,249 @@
 # Description:
 # 	Packet creation support library for the DFS project. Database info for
 #
+# 	Every message travels as a frame:
+#
+# 	    header | body | data
+#
+# 	The header is fixed size (magic, version, command, body length, data
+# 	length).  The body holds the JSON control fields followed by a compact
+# 	binary section for the block list.  Raw block bytes travel as the data
+# 	part, after the body, without going through JSON.
+#
 # Please modify globals with appropiate info.
 
 import json
+import os
+import select
+import struct
+import time
+import zlib
+
+import tracing
+
+# Frame header: magic, version, command code, body length, data length
+MAGIC = b"DF"
+VERSION = 1
+HEADER = struct.Struct("!2sBBIQ")
+
+# Length of the JSON part at the start of the body
+JSON_LEN = struct.Struct("!I")
+
+# Raw data larger than this is streamed in chunks of this size
+CHUNK = 1 << 20
+
+# Blocks are also checksummed in pieces of this size, so a range of a
+# block can be checked without reading all of it.  Divides CHUNK.
+CRC_CHUNK = 64 << 10
+
+# Binary block list: node table followed by (node index, offset, length,
+# block id) entries
+COUNT16 = struct.Struct("!H")
+COUNT32 = struct.Struct("!I")
+NODE = struct.Struct("!HB")
+BLOCK = struct.Struct("!HQIB")
+
+
+def recvall(sock, size):
+    """Receives exactly size bytes from sock into a preallocated buffer.
+        Raises ConnectionError if the peer closes the connection first.
+    """
+
+    buf = bytearray(size)
+    view = memoryview(buf)
+    while view:
+        n = sock.recv_into(view)
+        if not n:
+            raise ConnectionError("Connection closed by peer")
+        view = view[n:]
+    return buf
+
+
+def recvfile(sock, size, fd, offset=None, forward=None, timer=None, sums=None,
+             window=None):
+    """Receives exactly size bytes from sock and writes them to the file
+        descriptor fd, CHUNK bytes at a time so a large block never sits
+        fully in memory.  Writes at offset with pwrite if given, otherwise
+        at the current position of fd.
+        If forward is a socket every chunk is also sent through it as it
+        arrives.  Returns the CRC32 of the bytes received, and False if
+        forwarding failed part way, the bytes are still received and
+        written.
+        If timer is given it is called with the seconds spent writing to
+        fd once all the bytes are written.
+        If sums is a list the CRC32 of every CRC_CHUNK bytes received, and
+        of the shorter piece at the end, is appended to it.  If window is
+        a (skip, count) pair only count bytes of what is received, after
+        the first skip, are written.
+    """
+
+    crc = 0
+    part = 0
+    writing = 0.0
+    forwarded = True
+    skip, count = window or (0, size)
+    done = 0
+    buf = bytearray(min(size, CHUNK))
+    view = memoryview(buf)
+    while done < size:
+        n = sock.recv_into(view[:min(size - done, CHUNK)])
+        if not n:
+            raise ConnectionError("Connection closed by peer")
+        crc = zlib.crc32(view[:n], crc)
+        if sums is not None:
+            # Split what came in at the CRC_CHUNK boundaries of the stream
+            pos = done
+            while pos < done + n:
+                end = min(done + n, pos - pos % CRC_CHUNK + CRC_CHUNK)
+                part = zlib.crc32(view[pos - done:end - done], part)
+                if end % CRC_CHUNK == 0:
+                    sums.append(part)
+                    part = 0
+                pos = end
+        if forward is not None and forwarded:
+            try:
+                forward.sendall(view[:n])
+            except OSError:
+                forwarded = False
+
+        # Part of this piece inside the window
+        lo = max(done, skip)
+        hi = min(done + n, skip + count)
+        start = time.perf_counter()
+        if lo < hi:
+            if offset is None:
+                os.write(fd, view[lo - done:hi - done])
+            else:
+                os.pwrite(fd, view[lo - done:hi - done], offset + lo - skip)
+        writing += time.perf_counter() - start
+        done += n
+
+    if sums is not None and size % CRC_CHUNK:
+        sums.append(part)
+    if timer is not None:
+        timer(writing)
+    return crc, forwarded
+
+
+def sendfile(sock, fd, offset, count):
+    """Sends count bytes of the file descriptor fd, starting at offset,
+        through sock with os.sendfile.  Partial sends are resumed until
+        everything is sent.  Honors the timeout of sock, if it has one.
+    """
+
+    timeout = sock.gettimeout()
+    while count:
+        try:
+            n = os.sendfile(sock.fileno(), fd, offset, count)
+        except BlockingIOError:
+            # Socket with a timeout, wait until it can take more
+            if not select.select([], [sock], [], timeout)[1]:
+                raise TimeoutError("Send timed out")
+            continue
+        if not n:
+            raise EOFError("File shorter than expected")
+        offset += n
+        count -= n
+
+
+def EncodeBlocks(blocks):
+    """Packs a list of (address, port, block id, offset, length) tuples.
+        Every data node is written once in a node table and blocks refer to
+        it by index.
+    """
+
+    nodes = {}
+    entries = []
+    for address, port, blockid, offset, length in blocks:
+        idx = nodes.setdefault((address, port), len(nodes))
+        bid = str(blockid).encode()
+        entries.append(BLOCK.pack(idx, offset, length, len(bid)) + bid)
+
+    table = [COUNT16.pack(len(nodes))]
+    for address, port in nodes:
+        addr = address.encode()
+        table.append(NODE.pack(port, len(addr)) + addr)
+
+    return b"".join(table) + COUNT32.pack(len(entries)) + b"".join(entries)
+
+
+def DecodeBlocks(buf):
+    """Unpacks a block list created by EncodeBlocks."""
+
+    view = memoryview(buf)
+    pos = 0
+
+    (count,) = COUNT16.unpack_from(view, pos)
+    pos += COUNT16.size
+    nodes = []
+    for _ in range(count):
+        port, alen = NODE.unpack_from(view, pos)
+        pos += NODE.size
+        nodes.append((bytes(view[pos:pos + alen]).decode(), port))
+        pos += alen
+
+    (count,) = COUNT32.unpack_from(view, pos)
+    pos += COUNT32.size
+    blocks = []
+    for _ in range(count):
+        idx, offset, length, blen = BLOCK.unpack_from(view, pos)
+        pos += BLOCK.size
+        address, port = nodes[idx]
+        blockid = bytes(view[pos:pos + blen]).decode()
+        blocks.append((address, port, blockid, offset, length))
+        pos += blen
+
+    return blocks
+
+
+def EncodeBlockIDs(blockids):
+    """Packs a list of block ids, each one prefixed by its length, to be
+        sent as the raw data of block reports and heartbeats.
+    """
+
+    parts = []
+    for blockid in blockids:
+        bid = blockid.encode()
+        parts.append(bytes((len(bid),)) + bid)
+    return b"".join(parts)
+
+
+def DecodeBlockIDs(buf):
+    """Unpacks a list of block ids created by EncodeBlockIDs."""
+
+    view = memoryview(buf)
+    pos = 0
+    blockids = []
+    while pos < len(view):
+        blen = view[pos]
+        blockids.append(bytes(view[pos + 1:pos + 1 + blen]).decode())
+        pos += 1 + blen
+    return blockids
 
 
 class Packet:
 
     def __init__(self):
 
-        self.commands = ["reg", "list", "put", "get", "dblks"]
+        self.commands = ["reg", "list", "put", "get", "dblks", "hbeat", "brep", "chunks", "bad", "mget", "stats", "rm", "check"]
         self.packet = {}
+        self.datalen = 0
+        self.timing = None
 
     def getEncodedPacket(self):
-        """returns a seriliazed packet ready to send through the network.  
+        """returns a seriliazed packet ready to send through the network.
         First you need to build the packets.  See BuildXPacket functions."""
 
-        return json.dumps(self.packet).encode()
+        fields = dict(self.packet)
+        blocks = fields.pop("blocks", None)
+
+        # Requests carry the trace they are part of, if any
+        if "command" in fields and (ctx := tracing.context()) is not None:
+            fields["trace"] = ctx
+        body = json.dumps(fields).encode()
+        bulk = EncodeBlocks(blocks) if blocks is not None else b""
+
+        return JSON_LEN.pack(len(body)) + body + bulk
 
     def getCommand(self):
         """Returns the command type of a packet"""
@@ -31,6 +257,13 @@ class Packet:
             return self.packet["command"]
         return None
 
+    def getTrace(self):
+        """Returns the (trace id, span id) a request was sent under, None
+        if it is not traced"""
+        if "trace" in self.packet:
+            return tuple(self.packet["trace"])
+        return None
+
     def getAddr(self):
         """Returns the IP address of a server"""
         if "addr" in self.packet:
@@ -45,21 +278,203 @@ class Packet:
 
     def DecodePacket(self, packet):
         """Receives bytes and turns them into a packet object."""
-        self.packet = json.loads(packet.decode())
+
+        view = memoryview(packet)
+        (size,) = JSON_LEN.unpack_from(view)
+        end = JSON_LEN.size + size
+        self.packet = json.loads(bytes(view[JSON_LEN.size:end]))
+        if len(view) > end:
+            self.packet["blocks"] = DecodeBlocks(view[end:])
+
+    def getFrame(self, datalen=0):
+        """Returns the header and body of the frame for this packet, to be
+            followed by datalen bytes of raw data.  Can be kept and sent
+            again as it is.
+        """
+
+        body = self.getEncodedPacket()
+        cmd = self.getCommand()
+        code = self.commands.index(cmd) + 1 if cmd in self.commands else 0
+        return HEADER.pack(MAGIC, VERSION, code, len(body), datalen) + body
+
+    def SendPacket(self, sock, data=b""):
+        """Sends the packet as a frame through sock. data, if any, is sent
+            raw after the body.
+        """
+
+        frame = self.getFrame(len(data))
+        with tracing.span("send", bytes=len(frame) + len(data)):
+            if len(data) <= 65536:
+                # Small payloads go out in a single call
+                sock.sendall(frame + data)
+            else:
+                sock.sendall(frame)
+                sock.sendall(data)
+
+    def SendFilePacket(self, sock, fd, offset, count):
+        """Sends the packet as a frame through sock, followed by count raw
+            bytes of the file descriptor fd starting at offset.  The bytes
+            go from the file to the socket with sendfile.
+        """
+
+        frame = self.getFrame(count)
+        with tracing.span("send", bytes=len(frame) + count):
+            sock.sendall(frame)
+            sendfile(sock, fd, offset, count)
+
+    def RecvPacket(self, sock):
+        """Receives a frame from sock and decodes it into this packet.
+            Returns the length of the raw data that follows the body, which
+            the caller must read, or None if the peer closed the connection
+            before a new frame started.  When the frame started to arrive,
+            was read and was decoded is kept in timing.
+        """
+
+        header = bytearray(HEADER.size)
+        n = sock.recv_into(header)
+        if not n:
+            return None
+        arrived = time.time()
+        if n < HEADER.size:
+            header[n:] = recvall(sock, HEADER.size - n)
+
+        magic, version, code, blen, dlen = HEADER.unpack(header)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("Bad frame header")
+
+        body = recvall(sock, blen)
+        read = time.time()
+        self.DecodePacket(body)
+        self.datalen = dlen
+        self.timing = (arrived, read, time.time())
+        return dlen
 
     def BuildRegPacket(self, addr, port):
         """Builds a registration packet"""
         self.packet = {"command": "reg", "addr": addr, "port": port}
 
-    def BuildListPacket(self):
-        """Builds a list packet for file listing"""
+    def BuildHeartbeatPacket(self, addr, port, free, inflight, throughput):
+        """Builds a heartbeat packet with the free disk space, transfers in
+        flight and recent throughput (bytes per second) of a data node.
+        The ids of the blocks it removed since the last heartbeat follow as
+        raw data, and the response carries the ids of the next blocks to
+        remove the same way, see EncodeBlockIDs"""
+        self.BuildRegPacket(addr, port)
+        self.packet["command"] = "hbeat"
+        self.packet["free"] = free
+        self.packet["inflight"] = inflight
+        self.packet["throughput"] = throughput
+
+    def BuildHeartbeatResponse(self, age=0):
+        """Builds the metadata server response to a heartbeat.  The ids of
+        the blocks to remove follow as raw data, and only the copies stored
+        more than age seconds ago are to be removed"""
+        self.packet = {"status": "ACK", "age": age}
+
+    def getAge(self):
+        """Returns the age, in seconds, blocks must have to be removed"""
+        return self.packet.get("age", 0)
+
+    def getLoad(self):
+        """Returns the (free, inflight, throughput) of a heartbeat packet"""
+        if "free" in self.packet:
+            return self.packet["free"], self.packet["inflight"], self.packet["throughput"]
+        return None
+
+    def BuildBlockReportPacket(self, addr, port, count, orphans=False):
+        """Builds the block report of a data node, sent at startup.  The
+        ids of its count blocks follow as raw data, see EncodeBlockIDs.
+        With orphans the report is only checked for blocks no file uses,
+        and their ids come back as raw data"""
+        self.BuildRegPacket(addr, port)
+        self.packet["command"] = "brep"
+        self.packet["count"] = count
+        if orphans:
+            self.packet["orphans"] = True
+
+    def getOrphanCheck(self):
+        """True if a block report only asks for the blocks no file uses"""
+        return self.packet.get("orphans", False) is True
+
+    def BuildBlockReportResponse(self, status, lost=0, orphans=0, age=None):
+        """Builds the metadata server response to a block report, with
+        the number of blocks it expected and did not find, and the number
+        of reported blocks no file uses.  With age, only the unused blocks
+        stored more than age seconds ago are to be removed"""
+        self.packet = {"status": status, "lost": lost, "orphans": orphans}
+        if age is not None:
+            self.packet["age"] = age
+
+    def getReportResult(self):
+        """Returns the (lost, orphans) of a block report response"""
+        return self.packet.get("lost", 0), self.packet.get("orphans", 0)
+
+    def BuildStatusPacket(self, status):
+        """Builds a status response packet (ACK, NAK, DUP, NFOUND...)"""
+
+        self.packet = {"status": status}
+
+    def getStatus(self):
+        """Returns the status of a response packet"""
+
+        if "status" in self.packet:
+            return self.packet["status"]
+        return None
+
+    def BuildStatsPacket(self):
+        """Builds a packet asking a server for its metrics"""
+        self.BuildCommand("stats")
+
+    def BuildStatsResponse(self, stats):
+        """Builds the response to a stats packet, with the counters,
+        gauges and latency histograms of the server"""
+        self.packet = {"status": "ACK", "stats": stats}
+
+    def getStats(self):
+        """Returns the metrics in a stats response"""
+        if "stats" in self.packet:
+            return self.packet["stats"]
+        return None
+
+    def BuildListPacket(self, path="/", pattern=None, cursor=None):
+        """Builds a list packet for one page of the listing of directory
+        path.  pattern is a glob for the names to list and cursor the one
+        of the previous page."""
 
         self.BuildCommand("list")
+        self.packet["path"] = path
+        if pattern:
+            self.packet["pattern"] = pattern
+        if cursor:
+            self.packet["cursor"] = cursor
 
-    def BuildListResponse(self, lfiles):
-        """Builds a list response packet"""
+    def getListArgs(self):
+        """Returns the (path, pattern, cursor) of a list packet"""
+
+        return (self.packet.get("path", "/"), self.packet.get("pattern"),
+                self.packet.get("cursor"))
+
+    def BuildListResponse(self, lfiles, ldirs=None, cursor=None):
+        """Builds a list response packet, one page of subdirectories and
+        files, with the cursor of the next page if there is one"""
+
+        self.packet = {"files": lfiles, "dirs": ldirs or []}
+        if cursor:
+            self.packet["cursor"] = cursor
+
+    def getDirArray(self):
+        """Returns the subdirectories of a list response"""
 
-        self.packet = {"files": lfiles}
+        if "dirs" in self.packet:
+            return self.packet["dirs"]
+        return []
+
+    def getCursor(self):
+        """Returns the cursor of the next page of a list response"""
+
+        if "cursor" in self.packet:
+            return self.packet["cursor"]
+        return None
 
     def getFileArray(self):
         """Builds a list response packet"""
@@ -67,33 +482,210 @@ class Packet:
         if "files" in self.packet:
             return self.packet["files"]
 
+    def BuildRemovePacket(self, fname):
+        """Build a rm packet to remove fname."""
+        self.BuildCommand("rm")
+        self.packet["fname"] = fname
+
     def BuildGetPacket(self, fname):
         """Build a get packet to get fname."""
         self.BuildCommand("get")
         self.packet["fname"] = fname
 
-    def BuildPutPacket(self, fname, fsize):
-        """Builds a put packet to put fname and file size."""
+    def BuildPutPacket(self, fname, fsize, bsize=None, repl=None, codec=None):
+        """Builds a put packet to put fname and file size.  bsize asks for
+        a block size, repl for a replication factor and codec for the
+        compression of the blocks, otherwise the metadata server defaults
+        are used."""
         self.BuildCommand("put")
         self.packet["fname"] = fname
         self.packet["fsize"] = fsize
+        if bsize:
+            self.packet["bsize"] = bsize
+        if repl:
+            self.packet["repl"] = repl
+        if codec:
+            self.packet["codec"] = codec
+
+    def BuildPutBlockPacket(self, pipeline, blockid=None, codec=None, blen=None,
+                            crc=None):
+        """Builds a put packet to store a block in a data node.  pipeline
+        is the list of (address, port) of the data nodes the block must be
+        forwarded to, in order.  blockid is given when a data node forwards
+        the block down the pipeline, or when the client names the block
+        after the hash of its data.  If the block is compressed codec is
+        the one used and blen the length of the block decompressed.  crc is
+        the CRC32 of the bytes sent, checked by the data node."""
+        self.BuildCommand("put")
+        self.packet["pipeline"] = pipeline
+        if blockid:
+            self.packet["blockid"] = blockid
+        if crc is not None:
+            self.packet["crc"] = crc
+        if codec and codec != "none":
+            self.packet["codec"] = codec
+            self.packet["blen"] = blen
+
+    def getPipeline(self):
+        """Returns the data nodes a block must be forwarded to"""
+        if "pipeline" in self.packet:
+            return [tuple(node) for node in self.packet["pipeline"]]
+        return []
+
+    def getReplication(self):
+        """Returns the replication factor in a packet."""
+        if "repl" in self.packet:
+            return self.packet["repl"]
+        return None
 
-    def BuildDataBlockPacket(self, fname, block_list):
-        """Builds a data block packet. Contains the file name and the list of blocks for the file"""
+    def BuildDataBlockPacket(self, fname, block_list, crcs=None, refs=None):
+        """Builds a data block packet. Contains the file name and the list of blocks for the file.
+        A replicated block has one entry per replica, all with the same offset.
+        crcs has the CRC32 of every entry, None where it is not known.  refs
+        has the indexes of the entries that reference stored chunks instead
+        of uploaded ones."""
         self.BuildCommand("dblks")
         self.packet["blocks"] = block_list
         self.packet["fname"] = fname
+        if crcs is not None:
+            self.packet["crcs"] = crcs
+        if refs:
+            self.packet["refs"] = refs
+
+    def getReferences(self):
+        """Returns the indexes of the entries of a data block packet that
+        reference stored chunks"""
+        if "refs" in self.packet:
+            return self.packet["refs"]
+        return None
+
+    def BuildGoneResponse(self, cids):
+        """Builds the answer to a data block packet that references chunks
+        no longer stored, with their chunk ids, to be uploaded again"""
+        self.packet = {"status": "NAK", "gone": cids}
+
+    def getGone(self):
+        """Returns the chunk ids no longer stored of a data block response"""
+        if "gone" in self.packet:
+            return self.packet["gone"]
+        return None
+
+    def getChecksums(self):
+        """Returns the CRC32 of every block of a data block packet"""
+        if "crcs" in self.packet:
+            return self.packet["crcs"]
+        return None
 
-    def BuildGetDataBlockPacket(self, blockid):
-        """Builds a get data block packet. Usefull when requesting a data block to a data node."""
+    def BuildGetRangePacket(self, fname, offset, length):
+        """Build a get packet for the bytes [offset, offset + length) of fname."""
+        self.BuildGetPacket(fname)
+        self.packet["offset"] = offset
+        self.packet["length"] = length
+
+    def BuildGetDataBlockPacket(self, blockid, offset=0, length=None):
+        """Builds a get data block packet. Usefull when requesting a data block to a data node.
+        offset and length select a range inside the block."""
 
         self.BuildCommand("get")
         self.packet["blockid"] = blockid
+        if offset or length is not None:
+            self.packet["offset"] = offset
+            self.packet["length"] = length
+
+    def getRange(self):
+        """Returns the (offset, length) range of a get packet, None if the
+        whole file or block is requested."""
+        if "offset" in self.packet:
+            return self.packet["offset"], self.packet["length"]
+        return None
+
+    def BuildMultiGetPacket(self, ranges):
+        """Builds a get packet for many data blocks of a data node, sent back
+        one frame per block on the same connection.  ranges is a list of
+        (blockid, offset, length), a length of None is the whole block."""
+
+        self.BuildCommand("mget")
+        self.packet["ranges"] = [list(r) for r in ranges]
+
+    def getRanges(self):
+        """Returns the (blockid, offset, length) of every block of an mget
+        packet"""
+        return [tuple(r) for r in self.packet["ranges"]]
+
+    def BuildBlockIDResponse(self, blockid, replicas=None, codec=None, blen=None,
+                             crc=None, sums=None, skip=0):
+        """Builds the data node response to a put, with the new block id
+        and the (address, port) of the data nodes that stored it.  In the
+        response to a get of a compressed block codec is the one it is
+        compressed with and blen its length decompressed, and crc the
+        CRC32 of the whole stored block.  A range of a block goes with
+        the CRC32 sums of the CRC_CHUNK pieces that cover it, and starts
+        skip bytes before the range at the start of the first piece."""
+
+        self.packet = {"blockid": blockid}
+        if crc is not None:
+            self.packet["crc"] = crc
+        if sums is not None:
+            self.packet["sums"] = sums
+            self.packet["skip"] = skip
+        if replicas is not None:
+            self.packet["replicas"] = replicas
+        if codec and codec != "none":
+            self.packet["codec"] = codec
+            self.packet["blen"] = blen
+
+    def getChecksum(self):
+        """Returns the CRC32 of a block, None if not given"""
+        if "crc" in self.packet:
+            return self.packet["crc"]
+        return None
+
+    def getSums(self):
+        """Returns the CRC32 sums of the pieces of a block range and the
+        bytes before the range they start at, (None, 0) if not given"""
+        if "sums" in self.packet:
+            return self.packet["sums"], self.packet["skip"]
+        return None, 0
+
+    def BuildCheckBlockPacket(self, blockid):
+        """Builds the report of a client that read a corrupt block, for the
+        data node to check it"""
+        self.BuildCommand("check")
+        self.packet["blockid"] = blockid
+
+    def BuildCorruptBlockPacket(self, addr, port, blockid):
+        """Builds the report of a data node that found a corrupt block"""
+        self.BuildRegPacket(addr, port)
+        self.packet["command"] = "bad"
+        self.packet["blockid"] = blockid
+
+    def BuildRepairResponse(self, nodes):
+        """Builds the list of (address, port) of the live data nodes with a
+        good replica of a corrupt block, to copy it from"""
+        self.packet = {"status": "ACK", "servers": nodes}
+
+    def getCodec(self):
+        """Returns the compression codec of a packet, None if not given"""
+        if "codec" in self.packet:
+            return self.packet["codec"]
+        return None
+
+    def getBlockLength(self):
+        """Returns the length of a compressed block once decompressed"""
+        if "blen" in self.packet:
+            return self.packet["blen"]
+        return None
 
     def getBlockID(self):
         # Returns a the block_id from a packet.
         return self.packet["blockid"]
 
+    def getReplicas(self):
+        """Returns the data nodes that stored a block"""
+        if "replicas" in self.packet:
+            return [tuple(node) for node in self.packet["replicas"]]
+        return []
+
     def getFileInfo(self):
         """Returns the file info in a packet."""
         if "fname" in self.packet and "fsize" in self.packet:
@@ -106,13 +698,33 @@ class Packet:
 
     def BuildGetResponse(self, metalist, fsize):
         """Builds a list of data node servers with the blocks of a file, and file size."""
-        self.packet["servers"] = metalist
-        self.packet["fsize"] = fsize
+        self.packet = {"blocks": metalist, "fsize": fsize}
+
+    def BuildChunkQueryPacket(self, count):
+        """Builds a query for the data nodes that already store any of count
+        content addressed chunks.  The chunk ids follow as raw data, see
+        EncodeBlockIDs"""
+        self.BuildCommand("chunks")
+        self.packet["count"] = count
+
+    def BuildChunkQueryResponse(self, metalist):
+        """Builds the list of (address, port, chunk id, 0, length) of the
+        queried chunks that are already stored"""
+        self.packet = {"status": "ACK", "blocks": metalist}
 
-    def BuildPutResponse(self, metalist):
+    def BuildPutResponse(self, metalist, bsize, repl=1, codec="none"):
         """Builds a list of data node servers where a file data blocks can be stored.
-        I.E. a list of available data servers."""
-        self.packet["servers"] = metalist
+        I.E. a placement plan of (address, port, weight) of the available data
+        servers, the block size, the replication factor and the compression
+        codec of the file."""
+        self.packet = {"servers": metalist, "bsize": bsize, "repl": repl,
+                       "codec": codec}
+
+    def getBlockSize(self):
+        """Returns the block size in a packet."""
+        if "bsize" in self.packet:
+            return self.packet["bsize"]
+        return None
 
     def getDataNodes(self):
         """Returns a list of data servers"""
@@ -126,6 +738,12 @@ class Packet:
             return self.packet["blocks"]
         return None
 
+    def getFileSize(self):
+        """Returns the file size in a packet."""
+        if "fsize" in self.packet:
+            return self.packet["fsize"]
+        return None
+
     def BuildCommand(self, cmd):
         """Builds a packet type"""
         if cmd in self.commands:
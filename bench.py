@@ -0,0 +1,424 @@
+###############################################################################
+#
+# Filename: bench.py
+# Author: Jose R. Ortiz and Daniel Suazo
+#
+# Description:
+# 	Benchmark of the DFS on a local cluster.  Starts a metadata server and
+# 	data nodes on localhost, with a fresh database and data directories in
+# 	a temporary directory, and runs put, get and ls workloads through the
+# 	copy.py and ls.py clients.  Reports the throughput and latency of
+# 	every workload and the CPU and memory used by every process as JSON,
+# 	so the results of two versions can be compared.
+#
+
+import filecmp
+import json
+import math
+import os
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from sys import argv
+
+from Packet import Packet
+
+# Directory of the DFS scripts
+DFS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Size of every workload.  Sizes are in bytes.
+CONFIG = {
+    "small_files": 200,         # Files put and got one after another
+    "small_size": 16 << 10,
+    "huge_files": 2,            # A few large files
+    "huge_size": 64 << 20,
+    "huge_bsize": 1 << 20,
+    "clients": 8,               # Clients putting and getting at once
+    "client_files": 20,         # Files of every one of those clients
+    "client_size": 1 << 20,
+    "list_files": 10000,        # Files in the directory listed
+    "list_runs": 20,
+}
+
+# Smaller workloads for a quick check, with --quick
+QUICK = {
+    "small_files": 20,
+    "huge_files": 1,
+    "huge_size": 16 << 20,
+    "clients": 4,
+    "client_files": 5,
+    "list_files": 1000,
+    "list_runs": 5,
+}
+
+# Metrics compared by --compare, and whether higher is better
+METRICS = {"ops_per_s": True, "mb_per_s": True, "p50_ms": False, "p99_ms": False}
+
+# Seconds to wait for a server to start listening
+START_TIMEOUT = 10
+
+
+def usage():
+    print(f"""Usage: python {argv[0]} [--quick] <data nodes, default=3> <results file, default=stdout>
+       python {argv[0]} --compare <old results> <new results>""")
+    exit(0)
+
+
+def log(msg):
+    # Progress goes to stderr, stdout may be the results
+    print(msg, file=sys.stderr, flush=True)
+
+
+def percentile(values, q):
+    """Returns the q quantile (0 to 1) of values, by nearest rank"""
+
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[max(0, math.ceil(q * len(values)) - 1)]
+
+
+def free_port():
+    """Returns a TCP port nobody is listening on"""
+
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+def process_usage(pid):
+    """Returns the CPU seconds used so far and the current and peak
+        resident memory, in kB, of the process pid, read from /proc.
+    """
+
+    with open(f"/proc/{pid}/stat") as f:
+        # Fields after the command name, which may have spaces
+        fields = f.read().rsplit(")", 1)[1].split()
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+    mem = {}
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            if key in ("VmRSS", "VmHWM"):
+                mem[key] = int(value.split()[0])
+
+    return {"cpu_s": round(cpu, 3), "rss_kb": mem.get("VmRSS", 0),
+            "peak_rss_kb": mem.get("VmHWM", 0)}
+
+
+class Cluster:
+    """A metadata server and data nodes running on localhost, with their
+        database, data directories and logs in a temporary directory.
+    """
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.dir = tempfile.mkdtemp(prefix="dfs-bench-")
+        self.procs = {}
+        self.port = None
+
+    def spawn(self, name, script, *args):
+        """Starts script with args, its output goes to name.log"""
+
+        with open(os.path.join(self.dir, f"{name}.log"), "w") as out:
+            self.procs[name] = subprocess.Popen(
+                [sys.executable, os.path.join(DFS_DIR, script), *args],
+                cwd=self.dir, stdout=out, stderr=subprocess.STDOUT)
+
+    def wait(self, name, port):
+        """Waits until the process name listens on port"""
+
+        deadline = time.monotonic() + START_TIMEOUT
+        while time.monotonic() < deadline:
+            if self.procs[name].poll() is not None:
+                break
+            try:
+                socket.create_connection(("localhost", port)).close()
+                return
+            except OSError:
+                time.sleep(0.05)
+        raise RuntimeError(f"{name} did not start, see {self.dir}/{name}.log")
+
+    def start(self):
+        # Fresh database, createdb.py replaces the dfs.db it finds
+        open(os.path.join(self.dir, "dfs.db"), "w").close()
+        subprocess.run([sys.executable, os.path.join(DFS_DIR, "createdb.py")],
+                       cwd=self.dir, check=True, stdout=subprocess.DEVNULL)
+
+        self.port = free_port()
+        self.spawn("meta", "meta-data.py", str(self.port))
+        self.wait("meta", self.port)
+
+        # Data nodes register with the metadata server before they listen
+        for i in range(1, self.nodes + 1):
+            port = free_port()
+            path = os.path.join(self.dir, f"data{i}")
+            os.mkdir(path)
+            self.spawn(f"data{i}", "data-node.py", "localhost", str(port),
+                       path, str(self.port))
+            self.wait(f"data{i}", port)
+
+    def usage(self):
+        """Returns process_usage of every server process"""
+
+        return {name: process_usage(proc.pid) for name, proc in self.procs.items()}
+
+    def stop(self):
+        for proc in self.procs.values():
+            proc.terminate()
+        for proc in self.procs.values():
+            proc.wait()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+class Bench:
+    """Runs the workloads against a cluster and keeps their results"""
+
+    def __init__(self, cluster, config):
+        self.cluster = cluster
+        self.config = config
+        self.server = f"localhost:{cluster.port}"
+        self.work = os.path.join(cluster.dir, "work")
+        os.mkdir(self.work)
+        self.results = {}
+
+    def make_file(self, name, size):
+        """Writes size random bytes to name in the work directory"""
+
+        fname = os.path.join(self.work, name)
+        with open(fname, "wb") as f:
+            while size > 0:
+                f.write(os.urandom(min(size, 1 << 20)))
+                size -= 1 << 20
+        return fname
+
+    def client(self, script, *args):
+        """Runs a client script and returns the seconds it took"""
+
+        start = time.perf_counter()
+        done = subprocess.run([sys.executable, os.path.join(DFS_DIR, script), *args],
+                              cwd=self.work, stdout=subprocess.DEVNULL,
+                              stderr=subprocess.PIPE)
+        took = time.perf_counter() - start
+        if done.returncode:
+            raise RuntimeError(f"{script} {' '.join(args)} failed: {done.stderr.decode()}")
+        return took
+
+    def put(self, local, remote, *args):
+        return self.client("copy.py", local, f"{self.server}:{remote}", *map(str, args))
+
+    def get(self, remote, local, source):
+        # Downloads remote to local and checks it has the bytes of source,
+        # the file it was uploaded from
+        took = self.client("copy.py", f"{self.server}:{remote}", local)
+        if not filecmp.cmp(local, source, shallow=False):
+            raise RuntimeError(f"Got the wrong bytes of {remote}, expected the ones of {source}")
+        os.remove(local)
+        return took
+
+    def run(self, name, jobs, threads=1):
+        """Runs jobs, a list of (function, args, bytes), on threads threads
+            and records the throughput, latency and CPU use of the workload.
+        """
+
+        log(f"{name}: {len(jobs)} ops")
+        before = self.cluster.usage()
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        start = time.perf_counter()
+
+        with ThreadPoolExecutor(threads) as executor:
+            latencies = list(executor.map(lambda job: job[0](*job[1]), jobs))
+
+        seconds = time.perf_counter() - start
+        after = self.cluster.usage()
+        clients = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+        nbytes = sum(job[2] for job in jobs)
+        result = {
+            "ops": len(jobs),
+            "threads": threads,
+            "bytes": nbytes,
+            "seconds": round(seconds, 4),
+            "ops_per_s": round(len(jobs) / seconds, 2),
+            "mb_per_s": round(nbytes / seconds / (1 << 20), 2),
+            "p50_ms": round(percentile(latencies, 0.5) * 1000, 2),
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+            "max_ms": round(max(latencies) * 1000, 2),
+            "cpu_s": {p: round(after[p]["cpu_s"] - before[p]["cpu_s"], 3) for p in after},
+            "client_cpu_s": round(clients.ru_utime + clients.ru_stime
+                                  - children.ru_utime - children.ru_stime, 3),
+        }
+        self.results[name] = result
+        log(f"  {result['ops_per_s']} ops/s, {result['mb_per_s']} MB/s, "
+            f"p50 {result['p50_ms']} ms, p99 {result['p99_ms']} ms")
+
+    def small(self):
+        # Many small files, one after another
+        n, size = self.config["small_files"], self.config["small_size"]
+        local = self.make_file("small", size)
+        self.run("small_put", [(self.put, (local, f"/small/f{i}"), size) for i in range(n)])
+        out = os.path.join(self.work, "small.out")
+        self.run("small_get", [(self.get, (f"/small/f{i}", out, local), size) for i in range(n)])
+
+    def huge(self):
+        # A few huge files
+        n, size = self.config["huge_files"], self.config["huge_size"]
+        bsize = self.config["huge_bsize"]
+        local = self.make_file("huge", size)
+        self.run("huge_put", [(self.put, (local, f"/huge/f{i}", bsize), size) for i in range(n)])
+        out = os.path.join(self.work, "huge.out")
+        self.run("huge_get", [(self.get, (f"/huge/f{i}", out, local), size) for i in range(n)])
+
+    def concurrent(self):
+        # Many clients at once, every one with its own files
+        clients = self.config["clients"]
+        n, size = self.config["client_files"], self.config["client_size"]
+        local = self.make_file("client", size)
+        names = [f"/clients/c{c}/f{i}" for c in range(clients) for i in range(n)]
+        self.run("concurrent_put", [(self.put, (local, name), size) for name in names],
+                 clients)
+        self.run("concurrent_get",
+                 [(self.get, (name, os.path.join(self.work, f"{k}.out"), local), size)
+                  for k, name in enumerate(names)], clients)
+
+    def listing(self):
+        # A large directory.  Its files are created straight through the
+        # metadata server, as empty files, over a single connection.
+        n, runs = self.config["list_files"], self.config["list_runs"]
+        sock = socket.create_connection(("localhost", self.cluster.port))
+        p = Packet()
+
+        def create(name):
+            start = time.perf_counter()
+            p.BuildPutPacket(name, 0)
+            p.SendPacket(sock)
+            p.RecvPacket(sock)
+            if p.getStatus() in ("NAK", "DUP"):
+                raise RuntimeError(f"Could not create {name}")
+            return time.perf_counter() - start
+
+        self.run("namespace_put", [(create, (f"/list/f{i:07d}",), 0) for i in range(n)])
+
+        def page():
+            start = time.perf_counter()
+            p.BuildListPacket("/list")
+            p.SendPacket(sock)
+            p.RecvPacket(sock)
+            return time.perf_counter() - start
+
+        self.run("ls_page", [(page, (), 0) for _ in range(runs * 10)])
+        sock.close()
+
+        # Whole directory, and a glob matching a tenth of it, with ls.py
+        self.run("ls_full", [(self.client, ("ls.py", self.server, "/list"), 0)
+                             for _ in range(runs)])
+        self.run("ls_glob", [(self.client, ("ls.py", self.server, "/list", "*7"), 0)
+                             for _ in range(runs)])
+
+    def startup(self):
+        # Time to start a client that does nothing, included in the latency
+        # of every copy.py and ls.py run
+        took = [self.client("Packet.py") for _ in range(5)]
+        return round(percentile(took, 0.5) * 1000, 2)
+
+
+def version():
+    """Returns the git commit of the DFS, if it is a git checkout"""
+
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"],
+                              cwd=DFS_DIR, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except:
+        return None
+
+
+def benchmark(nodes, config):
+    """Runs every workload on a new cluster of nodes data nodes and
+        returns the results.
+    """
+
+    cluster = Cluster(nodes)
+    try:
+        cluster.start()
+        bench = Bench(cluster, config)
+        startup = bench.startup()
+        bench.small()
+        bench.huge()
+        bench.concurrent()
+        bench.listing()
+        processes = cluster.usage()
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    finally:
+        cluster.stop()
+
+    return {
+        "version": version(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": sys.version.split()[0],
+        "cpus": os.cpu_count(),
+        "nodes": nodes,
+        "config": config,
+        "client_startup_ms": startup,
+        "workloads": bench.results,
+        "processes": processes,
+        "clients": {"cpu_s": round(children.ru_utime + children.ru_stime, 3),
+                    "peak_rss_kb": children.ru_maxrss},
+    }
+
+
+def compare(old, new):
+    """Prints the change of every metric between two results files"""
+
+    with open(old) as f:
+        old = json.load(f)
+    with open(new) as f:
+        new = json.load(f)
+
+    print(f"{'workload':16} {'metric':10} {old['version'] or 'old':>14} "
+          f"{new['version'] or 'new':>14} {'change':>8}")
+    for name, result in new["workloads"].items():
+        if name not in old["workloads"]:
+            continue
+        for metric, higher in METRICS.items():
+            a, b = old["workloads"][name][metric], result[metric]
+            if not a and not b:
+                continue
+            change = (b - a) / a * 100 if a else 0
+            flag = "" if abs(change) < 10 or (change > 0) == higher else "  <- slower"
+            print(f"{name:16} {metric:10} {a:14} {b:14} {change:+7.1f}%{flag}")
+
+
+if __name__ == "__main__":
+
+    if "--compare" in argv:
+        if len(argv) != 4:
+            usage()
+        argv.remove("--compare")
+        compare(argv[1], argv[2])
+        exit(0)
+
+    config = dict(CONFIG)
+    if "--quick" in argv:
+        argv.remove("--quick")
+        config.update(QUICK)
+
+    try:
+        nodes = int(argv[1]) if len(argv) > 1 else 3
+    except:
+        usage()
+
+    results = benchmark(nodes, config)
+
+    out = json.dumps(results, indent=2)
+    if len(argv) > 2:
+        with open(argv[2], "w") as f:
+            f.write(out + "\n")
+    else:
+        print(out)
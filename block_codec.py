@@ -0,0 +1,54 @@
+###############################################################################
+#
+# Filename: block_codec.py
+# Author: Jose R. Ortiz and Daniel Suazo
+#
+# Description:
+# 	Block compression codecs for the DFS.  A file is stored with one codec,
+# 	chosen when it is put.  Every block is compressed on its own by the
+# 	copy client, so blocks can still be read one at a time, and blocks
+# 	that do not get smaller are stored as they are.  Data nodes keep the
+# 	codec of every block next to it, codec ids are what they store.
+#
+
+import lzma
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Codec names and the ids data nodes store them as
+CODECS = {"none": 0, "zlib": 1, "lzma": 2, "zstd": 3}
+NAMES = {cid: name for name, cid in CODECS.items()}
+
+
+def available():
+    """Returns the names of the codecs that can be used here"""
+
+    return [name for name in CODECS if name != "zstd" or zstandard is not None]
+
+
+def compress(codec, data):
+    """Compresses data with the codec named codec"""
+
+    if codec == "zlib":
+        return zlib.compress(data, 6)
+    if codec == "lzma":
+        return lzma.compress(data, preset=1)
+    if codec == "zstd":
+        return zstandard.ZstdCompressor().compress(data)
+    return data
+
+
+def decompress(codec, data):
+    """Decompresses data compressed with the codec named codec"""
+
+    if codec == "zlib":
+        return zlib.decompress(data)
+    if codec == "lzma":
+        return lzma.decompress(data)
+    if codec == "zstd":
+        return zstandard.ZstdDecompressor().decompress(data)
+    return data
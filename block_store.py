@@ -0,0 +1,551 @@
+###############################################################################
+#
+# Filename: block_store.py
+# Author: Jose R. Ortiz and Daniel Suazo
+#
+# Description:
+# 	Block store of a data node.  Instead of one file per block, blocks are
+# 	appended to large segment files and an index maps every block id to
+# 	its segment, offset and stored length, and to the codec the block is
+# 	compressed with, its length once decompressed and the CRC32 of the
+# 	stored bytes, checked on every read.  The index lives in memory and is
+# 	persisted as an append only log next to the segments.  Deleted and
+# 	replaced blocks leave dead space behind, which a background compaction
+# 	reclaims by moving the live blocks of mostly dead segments to the
+# 	active segment and removing the old segment file.
+#
+# 	Every block in a segment is stored as a record:
+#
+# 	    magic | id length | codec | data length | size | crc | block id | data | sums
+#
+# 	so the index can be rebuilt by scanning the segments, in parallel, if
+# 	its file is lost.  sums are the CRC32 of every CRC_CHUNK bytes of the
+# 	data, kept in the index too, so a range of a block can be checked on
+# 	its own.  Records written before there were sums have magic BK and
+# 	no sums, the scrubber and compaction move them to records with them.
+#
+
+from Packet import CHUNK, CRC_CHUNK
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import os
+import struct
+import threading
+import time
+import zlib
+
+# Segments are closed for new blocks once they reach this size
+SEGMENT_SIZE = 256 << 20
+
+# Sealed segments with less than this fraction of live bytes are compacted
+COMPACT_RATIO = 0.5
+
+# Seconds between compaction runs, and most bytes per second compaction
+# copies
+COMPACT_INTERVAL = 60
+COMPACT_RATE = 32 << 20
+
+# Most bytes per second the scrubber reads, and seconds between the end
+# of a scrub of every block and the start of the next one
+SCRUB_RATE = 8 << 20
+SCRUB_INTERVAL = 3600
+
+# Seconds between checks for blocks no file uses, and how long a block
+# has to stay unused before it is removed, so the blocks of uploads still
+# running are left alone
+GC_INTERVAL = 600
+GC_GRACE = 3600
+
+# Block record in a segment: magic, id length, codec, stored length,
+# length once decompressed and CRC32.  Records with SUMS_MAGIC have the
+# CRC32 of every CRC_CHUNK bytes of the data after it
+RECORD = struct.Struct("!2sBBQQI")
+RECORD_MAGIC = b"BK"
+SUMS_MAGIC = b"BS"
+SUM = struct.Struct("!I")
+
+# Index log entry: operation, id length, codec, segment, offset, stored
+# length, length once decompressed and CRC32, then the block id, and the
+# sums of the pieces of the block for PUT_SUMS
+ENTRY = struct.Struct("!BBBIQQQI")
+PUT = 1
+DELETE = 2
+PUT_SUMS = 3
+
+INDEX_NAME = "index.log"
+
+# Segments scanned at the same time when the index is rebuilt
+SCAN_THREADS = 8
+
+
+def checksum(fd, offset, length):
+    """Returns the CRC32 of length bytes at offset of the file descriptor fd"""
+
+    crc = 0
+    done = 0
+    while done < length:
+        data = os.pread(fd, min(CHUNK, length - done), offset + done)
+        if not data:
+            break
+        crc = zlib.crc32(data, crc)
+        done += len(data)
+    return crc
+
+
+def checksums(fd, offset, length):
+    """Returns the CRC32 of length bytes at offset of the file descriptor
+        fd, and the packed CRC32 of every CRC_CHUNK bytes of them.
+    """
+
+    crc = 0
+    sums = []
+    done = 0
+    while done < length:
+        data = os.pread(fd, min(CHUNK, length - done), offset + done)
+        if not data:
+            break
+        crc = zlib.crc32(data, crc)
+        for i in range(0, len(data), CRC_CHUNK):
+            sums.append(zlib.crc32(data[i:i + CRC_CHUNK]))
+        done += len(data)
+    return crc, pack_sums(sums)
+
+
+def pieces(length):
+    """Returns the number of CRC_CHUNK pieces of a block of length bytes"""
+
+    return -(-length // CRC_CHUNK)
+
+
+def pack_sums(sums):
+    """Returns a list of CRC32 sums packed the way they are stored"""
+
+    return struct.pack(f"!{len(sums)}I", *sums)
+
+
+def unpack_sums(sums, first, last):
+    """Returns the list of the packed sums of the pieces first to last,
+        last not included.
+    """
+
+    return list(struct.unpack_from(f"!{last - first}I", sums, first * SUM.size))
+
+
+class BlockStore:
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+        # blockid -> (segment, data offset, stored length, codec, size, crc)
+        self.index = {}
+
+        # blockid -> packed CRC32 of its pieces, for the blocks that have
+        # them
+        self.sums = {}
+
+        # Size and live bytes of every segment, and writes still running
+        # in each one
+        self.sizes = {}
+        self.live = {}
+        self.pending = {}
+        self.active = None
+
+        # Entries in the index log, to know when it is worth rewriting
+        self.entries = 0
+
+        # time.monotonic() when every block written since the store was
+        # opened was stored.  The others count as stored when it opened
+        self.written = {}
+        self.started = time.monotonic()
+
+        self._load()
+        self._import_legacy()
+
+    def _segment_path(self, seg):
+        return os.path.join(self.path, f"{seg:08d}.seg")
+
+    def _load(self):
+        """Reads the segment sizes and replays the index log"""
+
+        for name in os.listdir(self.path):
+            if name.endswith(".seg"):
+                seg = int(name[:-4])
+                self.sizes[seg] = os.path.getsize(self._segment_path(seg))
+                self.live[seg] = 0
+
+        index_path = os.path.join(self.path, INDEX_NAME)
+        if not os.path.exists(index_path) and self.sizes:
+            self._rebuild()
+            return
+
+        data = b""
+        if os.path.exists(index_path):
+            with open(index_path, "rb") as f:
+                data = f.read()
+
+        pos = 0
+        while pos + ENTRY.size <= len(data):
+            op, idlen, codec, seg, offset, length, size, crc = ENTRY.unpack_from(data, pos)
+            nsums = SUM.size * pieces(length) if op == PUT_SUMS else 0
+            if pos + ENTRY.size + idlen + nsums > len(data):
+                break
+            blockid = data[pos + ENTRY.size:pos + ENTRY.size + idlen].decode()
+            pos += ENTRY.size + idlen
+            sums = data[pos:pos + nsums]
+            pos += nsums
+            self.entries += 1
+
+            self._forget(blockid)
+            if op != DELETE and seg in self.sizes:
+                self.index[blockid] = (seg, offset, length, codec, size, crc)
+                self.live[seg] += RECORD.size + idlen + length + nsums
+                if op == PUT_SUMS:
+                    self.sums[blockid] = sums
+
+        # Drop an entry left half written by a crash
+        self.log = os.open(index_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        if pos < len(data):
+            os.truncate(self.log, pos)
+
+        # Keep appending to the last segment if it has room
+        if self.sizes and self.sizes[max(self.sizes)] < SEGMENT_SIZE:
+            self.active = max(self.sizes)
+
+    def _scan(self, seg):
+        """Returns the (blockid, offset, length, codec, size, crc, sums) of
+            every block record in a segment, in the order they were
+            written, sums None for records without them.  Stops at the
+            first record that is not complete, the tail of an interrupted
+            write.
+        """
+
+        records = []
+        fd = os.open(self._segment_path(seg), os.O_RDONLY)
+        try:
+            size = os.fstat(fd).st_size
+            pos = 0
+            while pos + RECORD.size <= size:
+                head = os.pread(fd, RECORD.size + 255, pos)
+                magic, idlen, codec, length, logical, crc = RECORD.unpack_from(head)
+                offset = pos + RECORD.size + idlen
+                nsums = SUM.size * pieces(length) if magic == SUMS_MAGIC else 0
+                if magic not in (RECORD_MAGIC, SUMS_MAGIC) \
+                        or offset + length + nsums > size:
+                    break
+                sums = None
+                if magic == SUMS_MAGIC:
+                    sums = os.pread(fd, nsums, offset + length)
+                records.append((head[RECORD.size:RECORD.size + idlen].decode(),
+                                offset, length, codec, logical, crc, sums))
+                pos = offset + length + nsums
+        finally:
+            os.close(fd)
+        return records
+
+    def _rebuild(self):
+        """Rebuilds the index by scanning every segment, several at a time,
+            and writes it out.  The last copy of a block wins.  Blocks
+            deleted since they were written come back, until the metadata
+            server reconciles them.
+        """
+
+        segs = sorted(self.sizes)
+        with ThreadPoolExecutor(SCAN_THREADS) as executor:
+            scans = executor.map(self._scan, segs)
+
+        for seg, records in zip(segs, scans):
+            for blockid, offset, length, codec, size, crc, sums in records:
+                self._forget(blockid)
+                self.index[blockid] = (seg, offset, length, codec, size, crc)
+                self.live[seg] += RECORD.size + len(blockid.encode()) + length
+                if sums is not None:
+                    self.sums[blockid] = sums
+                    self.live[seg] += len(sums)
+
+        self.log = os.open(os.path.join(self.path, INDEX_NAME),
+                           os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._rewrite_index()
+
+        if self.sizes[max(self.sizes)] < SEGMENT_SIZE:
+            self.active = max(self.sizes)
+
+    def _import_legacy(self):
+        """Moves blocks stored as one <blockid>.dat file each into segments"""
+
+        for name in os.listdir(self.path):
+            if not name.endswith(".dat"):
+                continue
+            src = os.path.join(self.path, name)
+            fd = os.open(src, os.O_RDONLY)
+            try:
+                size = os.fstat(fd).st_size
+                self._copy(name[:-4], fd, 0, size, 0, size, None)
+            finally:
+                os.close(fd)
+            os.remove(src)
+
+    def _forget(self, blockid):
+        """Drops blockid from the index, its bytes become dead space"""
+
+        old = self.index.pop(blockid, None)
+        sums = self.sums.pop(blockid, b"")
+        if old is not None:
+            seg, _, length, _, _, _ = old
+            self.live[seg] -= RECORD.size + len(blockid.encode()) + length + len(sums)
+
+    def _append(self, op, blockid, seg=0, offset=0, length=0, codec=0, size=0,
+                crc=0, sums=None):
+        """Appends an entry to the index log, a PUT_SUMS one if the sums of
+            the pieces of the block are given.
+        """
+
+        bid = blockid.encode()
+        if sums is not None:
+            op = PUT_SUMS
+        os.write(self.log, ENTRY.pack(op, len(bid), codec, seg, offset, length,
+                                      size, crc) + bid + (sums or b""))
+        self.entries += 1
+
+    def _reserve(self, size):
+        """Returns the active segment and the offset of size bytes reserved
+            at its end, starting a new segment when it is full.
+        """
+
+        if self.active is None or self.sizes[self.active] >= SEGMENT_SIZE:
+            self.active = max(self.sizes, default=-1) + 1
+            os.close(os.open(self._segment_path(self.active),
+                             os.O_WRONLY | os.O_CREAT, 0o644))
+            self.sizes[self.active] = 0
+            self.live[self.active] = 0
+
+        seg = self.active
+        start = self.sizes[seg]
+        self.sizes[seg] += size
+        self.pending[seg] = self.pending.get(seg, 0) + 1
+        return seg, start
+
+    @contextmanager
+    def writer(self, blockid, length, codec=0, size=None, crc=None, replaces=None,
+               sums=None):
+        """Reserves room for a block of length bytes at the end of the active
+            segment and yields (fd, offset, check) to write its data at.
+            codec is the one the data is compressed with and size its
+            length once decompressed, length if not given.  crc is the
+            CRC32 of the data and sums the packed CRC32 of its pieces, if
+            they are not known when the write starts the with block can
+            call check(crc, sums) once they are, otherwise they are read
+            back from the segment, and a crc that does not match raises
+            ValueError.  The block is
+            added to the index once the with block finishes without an
+            error.  If replaces is given the block is only added if the
+            index still has it at that location.
+        """
+
+        bid = blockid.encode()
+        if size is None:
+            size = length
+        nsums = SUM.size * pieces(length)
+        with self.lock:
+            seg, start = self._reserve(RECORD.size + len(bid) + length + nsums)
+
+        def check(value, parts=None):
+            nonlocal crc, sums
+            crc = value
+            sums = parts
+
+        fd = os.open(self._segment_path(seg), os.O_RDWR)
+        try:
+            # The record header goes first, so a scan can skip the record
+            # even if the write never finishes, and again with the checksum
+            os.pwrite(fd, RECORD.pack(SUMS_MAGIC, len(bid), codec, length, size,
+                                      crc or 0) + bid, start)
+            offset = start + RECORD.size + len(bid)
+            yield fd, offset, check
+
+            if sums is None:
+                got, sums = checksums(fd, offset, length)
+                if crc is not None and got != crc:
+                    raise ValueError("Checksum mismatch")
+                crc = got
+            os.pwrite(fd, sums, offset + length)
+            os.pwrite(fd, RECORD.pack(SUMS_MAGIC, len(bid), codec, length, size,
+                                      crc) + bid, start)
+            with self.lock:
+                if replaces is None or self.index.get(blockid) == replaces:
+                    self._forget(blockid)
+                    self._append(PUT, blockid, seg, offset, length, codec, size, crc,
+                                 sums)
+                    self.index[blockid] = (seg, offset, length, codec, size, crc)
+                    self.sums[blockid] = sums
+                    self.live[seg] += RECORD.size + len(bid) + length + nsums
+                    if replaces is None:
+                        self.written[blockid] = time.monotonic()
+        finally:
+            os.close(fd)
+            with self.lock:
+                self.pending[seg] -= 1
+
+    def _copy(self, blockid, src, offset, length, codec, size, crc, replaces=None,
+              sums=None):
+        """Writes length bytes at offset of the file descriptor src as
+            blockid.  Raises ValueError if they do not match crc.
+        """
+
+        with self.writer(blockid, length, codec, size, crc, replaces,
+                         sums) as (fd, start, _):
+            done = 0
+            while done < length:
+                data = os.pread(src, min(CHUNK, length - done), offset + done)
+                if not data:
+                    raise EOFError("Block shorter than expected")
+                os.pwrite(fd, data, start + done)
+                done += len(data)
+
+    @contextmanager
+    def reader(self, blockid):
+        """Yields (fd, offset, length, codec, size, crc, sums) to read a
+            block from: where its stored bytes are, the codec they are
+            compressed with, the length of the block once decompressed, the
+            CRC32 of the stored bytes and the packed CRC32 of its pieces,
+            None if it has no sums.  Raises FileNotFoundError if the block
+            is not stored here.
+        """
+
+        with self.lock:
+            if blockid not in self.index:
+                raise FileNotFoundError(f"No block {blockid}")
+            seg, offset, length, codec, size, crc = self.index[blockid]
+            sums = self.sums.get(blockid)
+            # Opened under the lock, compaction can remove the segment
+            # right after, but not before
+            fd = os.open(self._segment_path(seg), os.O_RDONLY)
+        try:
+            yield fd, offset, length, codec, size, crc, sums
+        finally:
+            os.close(fd)
+
+    def upgrade(self, blockid):
+        """Moves a block stored without the sums of its pieces to a new
+            record with them.  Raises ValueError if it is corrupt.
+        """
+
+        with self.lock:
+            where = self.index.get(blockid)
+            if where is None or blockid in self.sums:
+                return
+            src = os.open(self._segment_path(where[0]), os.O_RDONLY)
+        try:
+            self._copy(blockid, src, *where[1:], replaces=where)
+        finally:
+            os.close(src)
+
+    def prefetch(self, blockid):
+        """Asks the kernel to start reading a block into the page cache, so
+            it is there by the time it is read.  Does not wait for it.
+        """
+
+        try:
+            with self.reader(blockid) as (fd, offset, length, _, _, _, _):
+                os.posix_fadvise(fd, offset, length, os.POSIX_FADV_WILLNEED)
+        except FileNotFoundError:
+            pass
+
+    def blocks(self):
+        """Returns the ids of all the blocks stored here"""
+
+        with self.lock:
+            return list(self.index)
+
+    def stats(self):
+        """Returns the number of blocks and segments and the bytes used
+            and live in the segments.
+        """
+
+        with self.lock:
+            return {"store.blocks": len(self.index),
+                    "store.segments": len(self.sizes),
+                    "store.bytes": sum(self.sizes.values()),
+                    "store.live_bytes": sum(self.live.values())}
+
+    def delete(self, blockid, before=None):
+        """Removes a block.  Its space is reclaimed by compaction.  If
+            before, a time.monotonic() value, is given the block is only
+            removed if it was stored before then, so a block stored again
+            after it was deleted on the metadata server is kept.  Returns
+            False if the block is not removed.
+        """
+
+        with self.lock:
+            if blockid not in self.index:
+                return False
+            if before is not None and self.written.get(blockid, self.started) >= before:
+                return False
+            self.written.pop(blockid, None)
+            self._forget(blockid)
+            self._append(DELETE, blockid)
+            return True
+
+    def compact(self):
+        """Moves the live blocks of sealed segments that are mostly dead
+            space to the active segment and removes those segments, then
+            rewrites the index log if it is mostly stale entries.
+        """
+
+        with self.lock:
+            victims = [seg for seg, size in self.sizes.items()
+                       if seg != self.active and not self.pending.get(seg)
+                       and self.live[seg] < size * COMPACT_RATIO]
+
+        for seg in victims:
+            with self.lock:
+                blocks = [(blockid, where, self.sums.get(blockid))
+                          for blockid, where in self.index.items()
+                          if where[0] == seg]
+
+            src = os.open(self._segment_path(seg), os.O_RDONLY)
+            try:
+                for blockid, where, sums in blocks:
+                    try:
+                        self._copy(blockid, src, *where[1:], replaces=where,
+                                   sums=sums)
+                    except ValueError:
+                        # Corrupt, it stays until the scrubber repairs it
+                        pass
+                    time.sleep(where[2] / COMPACT_RATE)
+            finally:
+                os.close(src)
+
+            with self.lock:
+                # Every block was moved or deleted meanwhile
+                if self.live[seg] <= 0 and not self.pending.get(seg):
+                    del self.sizes[seg], self.live[seg]
+                    self.pending.pop(seg, None)
+                    os.remove(self._segment_path(seg))
+
+        with self.lock:
+            if self.entries > 2 * len(self.index) + 1024:
+                self._rewrite_index()
+
+    def _rewrite_index(self):
+        """Replaces the index log with one PUT or PUT_SUMS entry per stored
+            block
+        """
+
+        index_path = os.path.join(self.path, INDEX_NAME)
+        tmp = index_path + ".tmp"
+        with open(tmp, "wb") as f:
+            for blockid, (seg, offset, length, codec, size, crc) in self.index.items():
+                bid = blockid.encode()
+                sums = self.sums.get(blockid)
+                f.write(ENTRY.pack(PUT if sums is None else PUT_SUMS, len(bid),
+                                   codec, seg, offset, length, size, crc)
+                        + bid + (sums or b""))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, index_path)
+
+        os.close(self.log)
+        self.log = os.open(index_path, os.O_WRONLY | os.O_APPEND)
+        self.entries = len(self.index)
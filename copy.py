@@ -8,23 +8,511 @@
 #
 #
 
+import hashlib
 import socket
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import os
+import shutil
+import tempfile
 from os import path, stat
 
-from sys import argv, getsizeof
+from sys import argv, stdout
 
-from Packet import Packet
+from Packet import Packet, recvall, recvfile, EncodeBlockIDs, CHUNK
+from block_codec import available, compress, decompress
+from block_store import checksum
+import tracing
+
+# Maximum number of blocks in flight to a single data node, on upload
+# and download
+WINDOW = 4
+
+# Timeout of a block upload: TIMEOUT_FACTOR times the time the data node
+# is expected to take, never under MIN_TIMEOUT seconds.  A data node with
+# no uploads yet is expected to be as fast as the fastest one measured,
+# and gets FIRST_TIMEOUT seconds while no node has been measured.  A data
+# node that fails MAX_FAILURES uploads in a row gets no more blocks.
+TIMEOUT_FACTOR = 4
+MIN_TIMEOUT = 2
+FIRST_TIMEOUT = 10
+MAX_FAILURES = 3
+
+# Weight of the last upload in the moving averages of a data node
+EWMA = 0.3
+
+# Most blocks asked for in one mget.  Bounds the blocks read again from
+# another replica when a data node fails halfway through a batch.
+MGET_BATCH = 256
 
 
 def usage():
     exit(
-        f"""Usage:\n\tFrom DFS: python {argv[0]} <server>:<port>:<dfs file path> <destination file>\n\tTo   DFS: python {argv[0]} <source file> <server>:<port>:<dfs file path>""")
+        f"""Usage:\n\tFrom DFS: python {argv[0]} <server>:<port>:<dfs file path> <destination file>\n\tRange:    python {argv[0]} <server>:<port>:<dfs file path> <destination file or -> <offset> <length>\n\tTo   DFS: python {argv[0]} [--dedup] <source file> <server>:<port>:<dfs file path> <block size, optional> <replication, optional> <codec, optional: {"/".join(available())}>""")
+
+
+class NodePool:
+    """Pool of long lived connections to the data nodes, keyed by
+        (ip, port).  A connection carries many put/get requests back to
+        back and is returned to the pool after every request.
+    """
+
+    def __init__(self):
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, ip, port):
+        """Returns an idle connection to (ip, port) or opens a new one"""
+
+        with self.lock:
+            socks = self.idle.get((ip, port))
+            if socks:
+                return socks.pop()
+
+        with tracing.span("connect", node=f"{ip}:{port}"):
+            sock = socket.create_connection((ip, port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+    def release(self, ip, port, sock):
+        """Gives a connection back to the pool for the next request"""
+
+        with self.lock:
+            self.idle.setdefault((ip, port), []).append(sock)
+
+    def close(self):
+        """Closes every pooled connection"""
+
+        with self.lock:
+            for socks in self.idle.values():
+                for sock in socks:
+                    sock.close()
+            self.idle = {}
+
+
+class NodeStats:
+    """Live latency and throughput of a data node, as seen by this client,
+        kept as moving averages of the last uploads.
+    """
+
+    def __init__(self):
+        self.latency = 0.0
+        self.rate = None
+        self.failures = 0
+
+    def record(self, nbytes, seconds):
+        """Records an upload of nbytes that took seconds"""
+
+        rate = nbytes / max(seconds, 1e-6)
+        if self.rate is None:
+            self.latency, self.rate = seconds, rate
+        else:
+            self.latency += EWMA * (seconds - self.latency)
+            self.rate += EWMA * (rate - self.rate)
+        self.failures = 0
+
+    def timeout(self, nbytes):
+        """Seconds to wait for an upload of nbytes before giving up"""
+
+        if self.rate is None:
+            return FIRST_TIMEOUT
+        return max(MIN_TIMEOUT, TIMEOUT_FACTOR * (self.latency + nbytes / self.rate))
+
+
+class BlockQueue:
+    """Blocks of a file waiting to be uploaded.  Upload workers of every
+        data node take the next block as soon as they have room for it, so
+        fast data nodes take more blocks than slow ones.  A block that
+        failed goes back to the queue to be retried by another data node.
+    """
+
+    def __init__(self, fsize, bsize, skip=()):
+        self.fsize = fsize
+        self.bsize = bsize
+        self.fresh = ((i, offset) for i, offset in enumerate(range(0, fsize, bsize))
+                      if i not in skip)
+        self.retries = deque()
+        self.inflight = 0
+        self.cond = threading.Condition()
+
+    def next(self, node):
+        """Returns the next (index, offset, length, tried nodes) for node
+            to upload, None when there is nothing left for it.
+        """
+
+        with self.cond:
+            while True:
+                # Blocks other data nodes failed first
+                for block in self.retries:
+                    if node not in block[3]:
+                        self.retries.remove(block)
+                        self.inflight += 1
+                        return block
+
+                for i, offset in self.fresh:
+                    self.inflight += 1
+                    return i, offset, min(self.bsize, self.fsize - offset), set()
+
+                # Nothing left unless a block in flight fails
+                if not self.inflight:
+                    return None
+                self.cond.wait()
+
+    def done(self, block, node, ok):
+        """Marks a block as uploaded, or as failed by node"""
+
+        with self.cond:
+            self.inflight -= 1
+            if not ok:
+                block[3].add(node)
+                self.retries.append(block)
+            self.cond.notify_all()
+
+
+def putBlock(pool, ip, port, pipeline, fd, offset, length, timeout=None,
+             blockid=None, codec=None, data=None):
+    """Sends the length bytes at offset of the file descriptor fd as one
+        block to the data node (ip, port) over a pooled connection.  The
+        data node forwards it down the pipeline of data nodes to keep the
+        other replicas.  Returns the block id the node assigned to it, or
+        blockid if given, the list of data nodes that stored it and the
+        CRC32 of the bytes sent.  If data is given it is sent instead, the
+        block compressed with codec.  Raises TimeoutError if the data node
+        takes more than timeout seconds, and ConnectionError if the block
+        did not reach it intact.
+    """
+
+    # Take a connection to the data node from the pool
+    nodeSock = pool.acquire(ip, port)
+
+    try:
+        nodeSock.settimeout(timeout)
+
+        # Send put packet to data node with the block right after it,
+        # straight from the file
+        p = Packet()
+        if data is None:
+            crc = checksum(fd, offset, length)
+            p.BuildPutBlockPacket(pipeline, blockid, crc=crc)
+            p.SendFilePacket(nodeSock, fd, offset, length)
+        else:
+            crc = zlib.crc32(data)
+            p.BuildPutBlockPacket(pipeline, blockid, codec, length, crc)
+            p.SendPacket(nodeSock, data)
+
+        # Recieve block id from data node
+        p.RecvPacket(nodeSock)
+        if p.getStatus() == "NAK":
+            raise ConnectionError("Block damaged on the way to the data node")
+    except:
+        nodeSock.close()
+        raise
+
+    # Keep the connection open for the next block
+    pool.release(ip, port, nodeSock)
+
+    return p.getBlockID(), p.getReplicas(), crc
+
+
+def recvBlock(sock, p, offset, length, fd, pos):
+    """Receives the block of a get response, whose header is already in p,
+        and streams length bytes at offset of it to the file descriptor fd
+        at position pos.  Compressed blocks come whole and are
+        decompressed here.  Whole blocks are checked against their
+        checksum, and ranges against the sums of the pieces of the block
+        that cover them.  Returns False if the data node answered NAK or
+        the block is corrupt, the connection is still usable then.
+    """
+
+    if p.getStatus() == "NAK":
+        return False
+
+    # Recieve block, exactly as many bytes as announced
+    size = p.datalen
+    crc = p.getChecksum()
+    sums, skip = p.getSums()
+    if codec := p.getCodec():
+        data = bytes(recvall(sock, size))
+        got = zlib.crc32(data)
+        if crc is None or got == crc:
+            data = decompress(codec, data)
+            os.pwrite(fd, data[offset:offset + length], pos)
+    else:
+        # A range starts at the start of the piece it is in, only the
+        # range itself is written
+        got = [] if sums is not None else None
+        whole, _ = recvfile(sock, size, fd, pos, sums=got,
+                            window=(skip, min(length, size - skip)))
+        if sums is not None:
+            return got == sums
+        got = whole
+
+    return crc is None or got == crc
+
+
+def reportBlock(sock, blockid):
+    """Tells the data node at the other end of sock that the copy of
+        blockid it sent is corrupt, for it to check it and repair it.
+    """
+
+    p = Packet()
+    p.BuildCheckBlockPacket(blockid)
+    p.SendPacket(sock)
+    p.RecvPacket(sock)
+
+
+def getBlock(pool, ip, port, blockid, offset, length, fd, pos):
+    """Requests length bytes at offset of a block from the data node
+        (ip, port) over a pooled connection and streams them to the file
+        descriptor fd at position pos.  Raises ConnectionError if the block
+        is missing or corrupt.
+    """
+
+    # Take a connection to the data node from the pool
+    nodeSock = pool.acquire(ip, port)
+
+    try:
+        # Build packet and send request to data node
+        p = Packet()
+        p.BuildGetDataBlockPacket(blockid, offset, length)
+        p.SendPacket(nodeSock)
+
+        if p.RecvPacket(nodeSock) is None:
+            raise ConnectionError("Data node closed the connection")
+        if not recvBlock(nodeSock, p, offset, length, fd, pos):
+            if p.getStatus() != "NAK":
+                reportBlock(nodeSock, blockid)
+            raise ConnectionError("Corrupt block")
+    except:
+        nodeSock.close()
+        raise
+
+    # Keep the connection open for the next block
+    pool.release(ip, port, nodeSock)
+
+
+def getBlocks(pool, ip, port, items, fd):
+    """Requests many blocks from the data node (ip, port) with a single
+        mget over a pooled connection.  items is a list of (blockid,
+        offset, length, pos), the blocks come back in that order, one
+        frame each, and are written to fd as they arrive like getBlock
+        does.  Returns the indexes of the items that could not be read:
+        the corrupt ones and, if the connection fails, the ones that had
+        not arrived yet.  The corrupt ones are reported to the data node.
+    """
+
+    failed = []
+    corrupt = []
+    done = 0
+    nodeSock = None
+    try:
+        # Take a connection to the data node from the pool
+        nodeSock = pool.acquire(ip, port)
+
+        # Ask for all the blocks at once
+        p = Packet()
+        p.BuildMultiGetPacket([item[:3] for item in items])
+        p.SendPacket(nodeSock)
+
+        for blockid, offset, length, pos in items:
+            if p.RecvPacket(nodeSock) is None:
+                raise ConnectionError("Data node closed the connection")
+            if not recvBlock(nodeSock, p, offset, length, fd, pos):
+                failed.append(done)
+                if p.getStatus() != "NAK":
+                    corrupt.append(blockid)
+            done += 1
+
+        for blockid in corrupt:
+            reportBlock(nodeSock, blockid)
+    except (OSError, ValueError):
+        if nodeSock is not None:
+            nodeSock.close()
+        return failed + list(range(done, len(items)))
+
+    # Keep the connection open for the next batch
+    pool.release(ip, port, nodeSock)
+    return failed
+
 
+def checkBlocks(blocks, start, end):
+    """Exits if the blocks returned by the metadata server do not cover
+        the bytes [start, end) of the file without holes, like the
+        blocks of an upload that never finished.
+    """
+
+    covered = start
+    for offset, length in sorted({(b[3], b[4]) for b in blocks}):
+        if covered >= end:
+            break
+        if offset > covered:
+            break
+        covered = max(covered, offset + length)
+
+    if covered < end:
+        exit(f"File blocks missing from byte {covered}, exiting...")
+
+
+def fetchBlocks(blocks, fd, start, end):
+    """Fetches the bytes [start, end) of a file from the data nodes, given
+        the list of blocks that hold them.  Blocks are fetched from all
+        data nodes concurrently and each one is written with pwrite to fd
+        at its position relative to start.
+        Replicas of a block are consecutive entries with the same offset.
+        Reads are spread over the replicas, every data node is asked for
+        its share of the blocks in a few batches with mget, and blocks
+        that fail are read one at a time from the next replica.
+    """
+
+    pool = NodePool()
+
+    # Group the replicas of every block
+    replicas = []
+    for ip, port, blockId, offset, length in blocks:
+        if not replicas or replicas[-1][0] != offset:
+            replicas.append((offset, length, []))
+        replicas[-1][2].append((ip, port, blockId))
+
+    # Share the blocks out among the data nodes, rotating the replicas of
+    # every block so reads are spread over them
+    shares = {}
+    for seq, (offset, length, nodes) in enumerate(replicas):
+        # Part of the block inside [start, end)
+        lo = max(start, offset) - offset
+        hi = min(end, offset + length) - offset
+        if lo >= hi:
+            continue
+
+        k = seq % len(nodes)
+        nodes = nodes[k:] + nodes[:k]
+        shares.setdefault(nodes[0][:2], []).append((nodes, lo, hi, offset))
+
+    def download(nodes, lo, hi, offset):
+        for i, (ip, port, blockId) in enumerate(nodes):
+            try:
+                with tracing.span("get block", node=f"{ip}:{port}", bytes=hi - lo):
+                    getBlock(pool, ip, port, blockId, lo, hi - lo,
+                             fd, offset + lo - start)
+                return
+            except OSError:
+                # Try the next replica, if any
+                if i == len(nodes) - 1:
+                    raise
+        raise ConnectionError("No replica left")
+
+    def fetch(node, batch):
+        items = [(nodes[0][2], lo, hi - lo, offset + lo - start)
+                 for nodes, lo, hi, offset in batch]
+        with tracing.span("mget", node="%s:%d" % node, blocks=len(items)):
+            failed = getBlocks(pool, *node, items, fd)
+        for i in failed:
+            nodes, lo, hi, offset = batch[i]
+            download(nodes[1:], lo, hi, offset)
+
+    # Up to WINDOW batches in flight from each data node, each one
+    # streamed over its own connection
+    futures = []
+    with ThreadPoolExecutor(max(1, len(shares) * WINDOW)) as executor:
+        for node, share in shares.items():
+            size = min(MGET_BATCH, -(-len(share) // WINDOW))
+            for i in range(0, len(share), size):
+                futures.append(executor.submit(tracing.wrap(fetch), node,
+                                               share[i:i + size]))
+
+    pool.close()
+
+    # Check every block made it to the file
+    for future in futures:
+        try:
+            future.result()
+        except:
+            exit("Download from data node failed, exiting...")
+
+
+def compressBlock(fname, offset, length, codec):
+    """Returns the length bytes at offset of the file fname compressed with
+        codec, None if they do not get any smaller.  Runs in the
+        compression process pool.
+    """
+
+    with open(fname, "rb") as f:
+        data = os.pread(f.fileno(), length, offset)
+    packed = compress(codec, data)
+    return packed if len(packed) < len(data) else None
+
+
+def hashBlock(fd, offset, length):
+    """Returns the SHA-256 of the length bytes at offset of the file
+        descriptor fd, the chunk id of a content addressed block.
+    """
+
+    h = hashlib.sha256()
+    done = 0
+    while done < length:
+        data = os.pread(fd, min(CHUNK, length - done), offset + done)
+        if not data:
+            break
+        h.update(data)
+        done += len(data)
+    return h.hexdigest()
+
+
+def findChunks(sock, fd, fsize, bsize, blockIds):
+    """Hashes every block of the file descriptor fd and asks the metadata
+        server, through sock, which of them are already stored.  Fills
+        blockIds with the replicas of those blocks.  Returns the hash of
+        every block and the indexes of the blocks that are not uploaded:
+        the ones already stored and the repeats of an earlier block of
+        the file.
+    """
+
+    # Hash the blocks in parallel, hashlib lets go of the GIL
+    offsets = range(0, fsize, bsize)
+    with ThreadPoolExecutor(os.cpu_count() or 1) as executor:
+        hashes = list(executor.map(
+            lambda offset: hashBlock(fd, offset, min(bsize, fsize - offset)),
+            offsets))
 
-def copyToDFS(address, fname, path):
+    unique = list(dict.fromkeys(hashes))
+    p = Packet()
+    p.BuildChunkQueryPacket(len(unique))
+    p.SendPacket(sock, EncodeBlockIDs(unique))
+    p.RecvPacket(sock)
+
+    stored = {}
+    if p.getStatus() == "ACK":
+        for address, port, cid, _, _ in p.getDataBlocks():
+            stored.setdefault(cid, []).append((address, port))
+
+    skip = set()
+    first = set()
+    for i, (h, offset) in enumerate(zip(hashes, offsets)):
+        length = min(bsize, fsize - offset)
+        if h in stored:
+            blockIds[i] = [(address, port, h, offset, length)
+                           for address, port in stored[h]]
+            skip.add(i)
+        elif h in first:
+            skip.add(i)
+        else:
+            first.add(h)
+
+    print(f"{len(skip)} of {len(hashes)} blocks already stored")
+    return hashes, skip
+
+
+def copyToDFS(address, fname, path, bsize=None, repl=None, dedup=False,
+              codec=None):
     """ Contact the metadata server to ask to copu file fname,
         get a list of data nodes. Open the file in path to read,
-        divide in blocks and send to the data nodes.
+        divide in blocks and send to the data nodes.  bsize asks for a
+        block size and repl for a replication factor, by default the
+        metadata server chooses them.  With dedup blocks are named after
+        the hash of their data and only the blocks the DFS does not have
+        yet are uploaded.  codec asks for the blocks to be compressed.
     """
 
     # Create a connection to the data server
@@ -40,72 +528,202 @@ def copyToDFS(address, fname, path):
     # Create a Put packet with the fname and the length of the data,
     # and send it to the metadata server
     p = Packet()
-    p.BuildPutPacket(path, fsize)
-    metaSock.sendall(p.getEncodedPacket())
-
-    # If no error or file exists
-    # Get the list of data nodes.
-
-    message = b""
-    while buffer := metaSock.recv(1024):
-        message += buffer
-    if message and message == b"DUP":
+    with tracing.span("meta put"):
+        p.BuildPutPacket(path, fsize, bsize, repl, codec)
+        p.SendPacket(metaSock)
+
+        # If no error or file exists
+        # Get the list of data nodes.
+        p.RecvPacket(metaSock)
+    status = p.getStatus()
+    if status == "DUP":
         exit("File already in server, exiting...")
-    elif message == b"NAK":
+    elif status == "NAK":
         exit("Server Error, exiting...")
     else:
-        p.DecodePacket(message)
         print("Succesfully saved to inode")
 
-    # Close socket
-    metaSock.close()
-
-    # Open file and get data node list
-    fd = open(fname, "rb")
+    # Open file and get data node list, block size and replication factor
+    fd = os.open(fname, os.O_RDONLY)
     dataNodes = p.getDataNodes()
+    bsize = p.getBlockSize()
+    repl = p.getReplication() or 1
+    codec = p.getCodec() or "none"
+    if codec not in available():
+        exit(f"Codec {codec} not available, exiting...")
+
+    # Find the blocks that are already stored, in content addressed mode
+    blockIds = [None] * len(range(0, fsize, bsize))
+    crcs = [None] * len(blockIds)
+    hashes, skip = None, set()
+    if dedup:
+        with tracing.span("dedup"):
+            hashes, skip = findChunks(metaSock, fd, fsize, bsize, blockIds)
 
-    blockIds = []
-
-    # Send each node its 16kb chunk(s) and recieve each block id
-    block = fd.read(16384)
-    while block:
-        for ip, addr in dataNodes:
-            # Create a socket to data node and connect to it
-            nodeSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            nodeSock.connect((ip, addr))
-
-            # Send put packet to data node and wait for OK signal
-            nodeSock.send(p.getEncodedPacket())
-
-            if nodeSock.recv(1024) == b"OK":
-                nodeSock.send(block)
-
-            # Recieve block id from data node and store in blockIds
-            bid = nodeSock.recv(1024)
-
-            blockIds.append((ip, addr, str(bid.decode())))
+    # Close socket
+    metaSock.close()
 
-            # Read next 16 kb and exit loop if EOF was already reached
-            if not (block := fd.read(16384)):
-                break
+    # Blocks found stored, which the metadata server has to check are
+    # still there when they are added to the file
+    refs = {i for i in skip if blockIds[i] is not None}
+
+    pool = NodePool()
+
+    # Blocks are compressed in other processes, to use every core
+    compressor = ProcessPoolExecutor() if codec != "none" else None
+    stats = [NodeStats() for _ in dataNodes]
+
+    def uploader(n):
+        # Upload worker of data node n.  Takes the next block whenever it
+        # is free, until there are no blocks left or the node keeps failing
+        ip, port, _ = dataNodes[n]
+        while stats[n].failures < MAX_FAILURES:
+            if (block := queue.next(n)) is None:
+                return
+            i, offset, length, tried = block
+
+            # The block is sent once, to this data node, which forwards it
+            # down a chain of the next repl - 1 live data nodes
+            pipeline = [dataNodes[(n + k) % len(dataNodes)][:2]
+                        for k in range(1, len(dataNodes))
+                        if stats[(n + k) % len(dataNodes)].failures < MAX_FAILURES]
+            pipeline = pipeline[:repl - 1]
+
+            # Compress the block, and send it as it is if it does not shrink
+            data = None
+            if compressor is not None:
+                with tracing.span("compress", bytes=length):
+                    data = compressor.submit(compressBlock, fname, offset,
+                                             length, codec).result()
+
+            # Time out sends that take much longer than expected
+            expect = stats[n]
+            if expect.rate is None:
+                expect = max(stats, key=lambda s: s.rate or 0)
+
+            start = time.monotonic()
+            try:
+                with tracing.span("put block", node=f"{ip}:{port}", bytes=length):
+                    blockId, replicas, crcs[i] = putBlock(
+                        pool, ip, port, pipeline, fd, offset, length,
+                        expect.timeout(length), hashes[i] if hashes else None,
+                        codec, data)
+            except OSError:
+                # Timed out or failed, let another data node retry it
+                stats[n].failures += 1
+                queue.done(block, n, False)
+                continue
+
+            stats[n].record(length, time.monotonic() - start)
+            blockIds[i] = [(rip, rport, blockId, offset, length)
+                           for rip, rport in replicas]
+            queue.done(block, n, True)
+
+    # Divide the file in blocks of bsize and upload them concurrently.
+    # Every data node gets upload workers in proportion to its weight in
+    # the placement plan, and workers pull blocks from a shared queue, so
+    # blocks go to whichever data node has room first.  Blocks go from
+    # the file to the sockets without being read into memory.  blockIds
+    # keeps the file order, with the replicas of every block.
+    most = max(weight for _, _, weight in dataNodes)
+    workers = [n for n, (_, _, weight) in enumerate(dataNodes)
+               for _ in range(max(1, round(WINDOW * weight / most)))]
+    while True:
+        queue = BlockQueue(fsize, bsize, skip)
+        with tracing.span("upload", blocks=len(blockIds) - len(skip)), \
+                ThreadPoolExecutor(len(workers)) as executor:
+            futures = [executor.submit(tracing.wrap(uploader), n) for n in workers]
+
+        # Check every upload made it to a data node
+        for future in futures:
+            future.result()
+
+        # Blocks repeated in the file point to the chunk of their first copy
+        if hashes:
+            uploaded = {hashes[i]: i for i in range(len(hashes))
+                        if i not in skip and blockIds[i]}
+            for i in skip:
+                if blockIds[i] is None and hashes[i] in uploaded:
+                    first = uploaded[hashes[i]]
+                    offset = i * bsize
+                    length = min(bsize, fsize - offset)
+                    blockIds[i] = [(rip, rport, cid, offset, length)
+                                   for rip, rport, cid, _, _ in blockIds[first]]
+                    crcs[i] = crcs[first]
+
+        if None in blockIds:
+            exit("Upload to data nodes failed, exiting...")
+
+        if any(len(replicas) < repl for replicas in blockIds):
+            print(f"Warning: some blocks have less than {repl} replicas")
+
+        # Notify the metadata server where the blocks are saved.
+
+        # Build packet, marking the entries of the blocks found stored
+        entries = [(i, b) for i, replicas in enumerate(blockIds) for b in replicas]
+        p.BuildDataBlockPacket(path, [b for _, b in entries],
+                               [crcs[i] for i, _ in entries],
+                               [k for k, (i, _) in enumerate(entries) if i in refs])
+
+        with tracing.span("meta dblks"):
+            # Create final socket to Metadata server and connect do it
+            finalSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            try:
+                finalSock.connect(address)
+            except:
+                exit("Connection to Metadata Server failed, exiting...")
+
+            # Send the created packet and wait until the blocks are committed
+            p.SendPacket(finalSock)
+            p.RecvPacket(finalSock)
+            finalSock.close()
+
+        gone = p.getGone()
+        if p.getStatus() == "ACK" or not gone:
+            break
 
-            # Close socket
-            nodeSock.close()
+        # Stored chunks were deleted before the file got to reference
+        # them.  Upload those blocks after all, once per chunk, and add
+        # the blocks again
+        gone = set(gone)
+        again = {i for i in refs if hashes[i] in gone}
+        print(f"{len(again)} blocks were deleted meanwhile, uploading them")
+        refs -= again
+        for i in again:
+            blockIds[i] = None
+        firsts = {}
+        for i in sorted(again):
+            firsts.setdefault(hashes[i], i)
+        skip = set(range(len(blockIds))) - set(firsts.values())
+
+    os.close(fd)
+    pool.close()
+    if compressor is not None:
+        compressor.shutdown()
+
+    if p.getStatus() != "ACK":
+        exit("Could not save the blocks in the Metadata Server, exiting...")
+
+
+def getFileBlocks(address, p):
+    """Sends the get packet p to the metadata server and returns the
+        response with the file size and block list.
+    """
 
-    # Notify the metadata server where the blocks are saved.
+    with tracing.span("meta get"):
+        # Create socket and connect to metadata server
+        metaSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        metaSock.connect(address)
 
-    # Build packet
-    p.BuildDataBlockPacket(path, blockIds)
+        p.SendPacket(metaSock)
 
-    # Create final socket to Metadata server and connect do it
-    finalSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    try:
-        finalSock.connect(address)
-    except:
-        exit("Connection to Metadata Server failed, exiting...")
+        # Recieve chunk list, if file not found, exit
+        p.RecvPacket(metaSock)
+        metaSock.close()
+    if p.getStatus() == "NFOUND":
+        exit("File not found, exiting...")
 
-    # Send the created packet
-    finalSock.sendall(p.getEncodedPacket())
+    return p
 
 
 def copyFromDFS(address, fname, path):
@@ -115,56 +733,74 @@ def copyFromDFS(address, fname, path):
     """
 
     # Contact the metadata server to ask for information of fname
-
-    # Create socket and connect to metadata server
-    metaSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    metaSock.connect(address)
-
-    # Create get packet and send request to metadata server
     p = Packet()
     p.BuildGetPacket(fname)
+    getFileBlocks(address, p)
 
-    metaSock.sendall(p.getEncodedPacket())
+    # If there is no error response Retreive the data blocks
 
-    # Recieve chunk list
-    msg = b""
-    while True:
-        buffer = metaSock.recv(2048)
-        msg += buffer
-        if getsizeof(buffer) < 2048:
-            break
+    # Get blocks
+    blocks = p.getDataBlocks() or []
+    fsize = p.getFileSize()
+    checkBlocks(blocks, 0, fsize)
 
-    # If file not found, exit, if file found, decode packet
-    if msg != b"NFOUND":
-        p.DecodePacket(msg)
-    else:
-        exit("File not found, exiting...")
+    # Open file and give it its final size so blocks can be written at
+    # their offsets in any order
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    os.ftruncate(fd, fsize)
 
-    # If there is no error response Retreive the data blocks
+    # Fetch the blocks from all data nodes concurrently and write each
+    # one at its position in the file
+    with tracing.span("download", blocks=len(blocks)):
+        fetchBlocks(blocks, fd, 0, fsize)
 
-    # Get blocks
-    blocks = p.getDataNodes()
+    os.close(fd)
 
-    # Open file
-    fd = open(path, "wb+")
-    for ip, addr, blockId in blocks:
-        # Create socket and connect to node
-        nodeSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        nodeSock.connect((ip, addr))
 
-        # Build packet and send request to data node
-        p.BuildGetDataBlockPacket(blockId)
-        nodeSock.send(p.getEncodedPacket())
+def copyRangeFromDFS(address, fname, path, offset, length):
+    """ Like copyFromDFS, but only reads the bytes [offset, offset + length)
+        of fname.  The metadata server returns just the blocks covering the
+        range, and only the needed part of each block is requested from the
+        data nodes.  A path of "-" writes the range to stdout.
+    """
 
-        # Recieve block and write to file named path
-        fd.write(nodeSock.recv(16384))
+    # Ask the metadata server for the blocks covering the range
+    p = Packet()
+    p.BuildGetRangePacket(fname, offset, length)
+    getFileBlocks(address, p)
+
+    blocks = p.getDataBlocks() or []
+    end = min(offset + length, p.getFileSize())
+    size = max(0, end - offset)
+    checkBlocks(blocks, offset, end)
+
+    # Blocks are written at their position, so stdout goes through a
+    # temporary file
+    if path == "-":
+        tmp = tempfile.TemporaryFile()
+        fd = tmp.fileno()
+    else:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    os.ftruncate(fd, size)
 
-        # Close socket
-        nodeSock.close()
+    with tracing.span("download", blocks=len(blocks)):
+        fetchBlocks(blocks, fd, offset, end)
+
+    if path == "-":
+        shutil.copyfileobj(tmp, stdout.buffer)
+        tmp.close()
+    else:
+        os.close(fd)
 
 
 if __name__ == "__main__":
     #	client("localhost", 8000)
+
+    # Content addressed upload
+    dedup = "--dedup" in argv
+    if dedup:
+        argv.remove("--dedup")
+
     if len(argv) < 3:
         usage()
 
@@ -182,7 +818,18 @@ if __name__ == "__main__":
                 f"Error: path {to_path} is a directory.  Please name the file.")
             usage()
 
-        copyFromDFS((ip, port), from_path, to_path)
+        if len(argv) > 4:
+            try:
+                offset = int(argv[3])
+                length = int(argv[4])
+            except:
+                usage()
+            with tracing.start("copy get", file=from_path, offset=offset,
+                               length=length):
+                copyRangeFromDFS((ip, port), from_path, to_path, offset, length)
+        else:
+            with tracing.start("copy get", file=from_path):
+                copyFromDFS((ip, port), from_path, to_path)
 
     elif len(file_to) > 1:
         ip = file_to[0]
@@ -195,4 +842,22 @@ if __name__ == "__main__":
                 f"Error: path {from_path} is a directory.  Please name the file.")
             usage()
 
-        copyToDFS((ip, port), from_path, to_path)
+        bsize = None
+        repl = None
+        codec = None
+        try:
+            if len(argv) > 3:
+                bsize = int(argv[3])
+            if len(argv) > 4:
+                repl = int(argv[4])
+            if len(argv) > 5:
+                codec = argv[5]
+        except:
+            usage()
+
+        if codec is not None and codec not in available():
+            print(f"Error: codec {codec} is not available.")
+            usage()
+
+        with tracing.start("copy put", file=to_path, size=stat(from_path).st_size):
+            copyToDFS((ip, port), from_path, to_path, bsize, repl, dedup, codec)
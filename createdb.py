@@ -11,7 +11,18 @@ conn = sqlite3.connect("dfs.db")
 c = conn.cursor()
 
 # Create inode table
-c.execute("""CREATE TABLE inode (fid INTEGER PRIMARY KEY ASC AUTOINCREMENT, fname TEXT UNIQUE NOT NULL DEFAULT " ", fsize INTEGER NOT NULL default "0")""")
+c.execute("""CREATE TABLE inode (fid INTEGER PRIMARY KEY ASC AUTOINCREMENT, fname TEXT UNIQUE NOT NULL DEFAULT " ", fsize INTEGER NOT NULL default "0", bsize INTEGER NOT NULL default "16384", repl INTEGER NOT NULL default "1", codec TEXT NOT NULL default "none", did INTEGER NOT NULL default "1", name TEXT NOT NULL default "", created REAL NOT NULL default 0)""")
+
+# Create directory table, the root directory is did 1
+c.execute("""CREATE TABLE dir (did INTEGER PRIMARY KEY ASC AUTOINCREMENT, parent INTEGER NOT NULL DEFAULT 0, name TEXT NOT NULL DEFAULT "")""")
+c.execute("""CREATE UNIQUE INDEX dirpn ON dir(parent, name)""")
+c.execute("""INSERT INTO dir (did, parent, name) VALUES (1, 0, '')""")
+
+# Create index of the files of every directory, by name
+c.execute("""CREATE INDEX inodedn ON inode(did, name)""")
+
+# Create index of the files by creation time, to find uploads running
+c.execute("""CREATE INDEX inodec ON inode(created)""")
 
 # Create data node table
 c.execute("""CREATE TABLE dnode(nid INTEGER PRIMARY KEY ASC AUTOINCREMENT, address TEXT NOT NULL default " ", port INTEGER NOT NULL DEFAULT "0")""")
@@ -19,8 +30,28 @@ c.execute("""CREATE TABLE dnode(nid INTEGER PRIMARY KEY ASC AUTOINCREMENT, addre
 # Create UNIQUE tuple for data node
 c.execute("""CREATE UNIQUE INDEX dnodeA ON dnode(address, port)""")
 
-# Create block table
-c.execute("""CREATE TABLE block (bid INTEGER PRIMARY KEY ASC AUTOINCREMENT, fid INTEGER NOT NULL DEFAULT "0", nid INTEGER NOT NULL DEFAULT "0", cid TEXT NOT NULL DEFAULT "0")""")
+# Create block table. seq is the position of the block in the file,
+# boffset and blen the byte range of the file it holds and crc the CRC32
+# of the block as stored
+c.execute("""CREATE TABLE block (bid INTEGER PRIMARY KEY ASC AUTOINCREMENT, fid INTEGER NOT NULL DEFAULT "0", nid INTEGER NOT NULL DEFAULT "0", cid TEXT NOT NULL DEFAULT "0", seq INTEGER NOT NULL DEFAULT "0", boffset INTEGER NOT NULL DEFAULT "0", blen INTEGER NOT NULL DEFAULT "0", crc INTEGER)""")
+
+# Create index of the blocks of every chunk on a data node
+c.execute("""CREATE INDEX blocknc ON block(nid, cid)""")
+
+# Create chunk table.  Counts the blocks that reference every chunk kept
+# by a data node, chunks of content addressed files are shared
+c.execute("""CREATE TABLE chunk (cid TEXT NOT NULL, nid INTEGER NOT NULL, blen INTEGER NOT NULL DEFAULT 0, refs INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (cid, nid))""")
+
+# Create ordered indexes of the blocks of a file, by sequence and by offset
+c.execute("""CREATE INDEX blockfs ON block(fid, seq)""")
+c.execute("""CREATE INDEX blockfo ON block(fid, boffset)""")
+
+# Create deletion queue.  Chunks of deleted files that their data node
+# has to remove, handed to it in heartbeats
+c.execute("""CREATE TABLE deleteq (nid INTEGER NOT NULL, cid TEXT NOT NULL, queued REAL NOT NULL DEFAULT 0, PRIMARY KEY (nid, cid))""")
+
+# Record the schema version, see mds_db.Migrate
+c.execute("""PRAGMA user_version = 9""")
 
-# Create UNIQUE tuple for block
-c.execute("""CREATE UNIQUE INDEX blocknc ON block(nid, cid)""")
+conn.commit()
+conn.close()
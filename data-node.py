@@ -7,13 +7,26 @@
 # 	data node server for the DFS
 #
 
-from Packet import Packet
-
-from sys import argv, getsizeof
+from Packet import Packet, recvall, recvfile, EncodeBlockIDs, DecodeBlockIDs, CRC_CHUNK
+from node_monitor import HEARTBEAT_INTERVAL
+from block_store import BlockStore, checksum, pieces, pack_sums, unpack_sums, \
+    COMPACT_INTERVAL, SCRUB_RATE, SCRUB_INTERVAL, GC_INTERVAL, GC_GRACE
+from block_codec import CODECS, NAMES
+from metrics import Metrics, CountingSocket, getLogger
+import tracing
+
+from sys import argv
+from contextlib import contextmanager, ExitStack
+import shutil
 import socket
 import socketserver
+import threading
+import time
 from uuid import uuid1
-import os.path
+import os
+
+# Blocks of an mget read ahead from disk while the one before is sent
+READAHEAD = 4
 
 
 def usage():
@@ -33,95 +46,524 @@ def register(meta_ip, meta_port, data_ip, data_port):
     sock.connect((meta_ip, meta_port))
 
     try:
-        response = b"NAK"
+        response = "NAK"
         # Initialize packet
         sp = Packet()
-        while response == b"NAK":
+        while response == "NAK":
             # Create reg packet and send to meta data server
             sp.BuildRegPacket(data_ip, data_port)
-            sock.sendall(sp.getEncodedPacket())
+            sp.SendPacket(sock)
 
             # Recieve response from meta data server
-            response = sock.recv(1024)
+            sp.RecvPacket(sock)
+            response = sp.getStatus()
 
-            if response == b"DUP":
+            if response == "DUP":
                 # If data node already registered
-                print("Duplicate Registration")
+                log.warning("Duplicate Registration")
 
-            if response == b"NAK":
+            if response == "NAK":
                 # If internal Server Error
-                print("Registratation ERROR")
+                log.error("Registratation ERROR")
 
-            if response == b"ACK":
+            if response == "ACK":
                 # If data node registered successfully
-                print("Registered succesfully")
+                log.info("Registered succesfully")
+
+    finally:
+        sock.close()
+
+
+def report(meta_ip, meta_port, data_ip, data_port, store):
+    """Sends the ids of all the blocks in the store to the metadata server,
+        which reconciles them with the blocks it expects this data node to
+        have.  Sent before serving any request, so no block is written in
+        between.
+    """
 
+    sock = socket.create_connection((meta_ip, meta_port))
+    try:
+        blockids = store.blocks()
+        sp = Packet()
+        sp.BuildBlockReportPacket(data_ip, data_port, len(blockids))
+        sp.SendPacket(sock, EncodeBlockIDs(blockids))
+
+        sp.RecvPacket(sock)
+        if sp.getStatus() == "ACK":
+            lost, orphans = sp.getReportResult()
+            log.info("Block report: %d blocks, %d lost, %d unused", len(blockids), lost, orphans)
+        else:
+            log.error("Block report ERROR")
     finally:
         sock.close()
 
 
+class NodeLoad:
+    """Transfers in flight and bytes moved by this data node, reported to
+        the metadata server in every heartbeat.
+    """
+
+    def __init__(self):
+        self.inflight = 0
+        self.moved = 0
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def transfer(self):
+        """Counts a transfer as in flight while it runs"""
+
+        with self.lock:
+            self.inflight += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.inflight -= 1
+
+    def add(self, nbytes):
+        """Counts nbytes sent or received"""
+
+        with self.lock:
+            self.moved += nbytes
+
+    def throughput(self, seconds):
+        """Returns the bytes per second moved in the last seconds and
+            starts counting again.
+        """
+
+        with self.lock:
+            moved, self.moved = self.moved, 0
+        return int(moved / seconds) if seconds > 0 else 0
+
+
+load = NodeLoad()
+
+# Request counts, latencies and disk times of this data node
+metrics = Metrics()
+log = getLogger("data-node")
+
+
+def heartbeat(meta_ip, meta_port, data_ip, data_port, data_path, store):
+    """Sends a heartbeat with the free disk space and load of this data
+        node to the metadata server every HEARTBEAT_INTERVAL seconds.
+        Removes the blocks of deleted files the metadata server answers
+        with, and tells it so in the next heartbeat.  Reconnects if the
+        metadata server goes away.
+    """
+
+    sock = None
+    p = Packet()
+    removed = []
+    last = time.monotonic()
+    while True:
+        now = time.monotonic()
+        free = shutil.disk_usage(data_path).free
+        p.BuildHeartbeatPacket(data_ip, data_port, free, load.inflight,
+                               load.throughput(now - last))
+        last = now
+
+        try:
+            if sock is None:
+                sock = socket.create_connection((meta_ip, meta_port))
+            sent = time.monotonic()
+            p.SendPacket(sock, EncodeBlockIDs(removed))
+            p.RecvPacket(sock)
+            delete = DecodeBlockIDs(recvall(sock, p.datalen))
+        except OSError:
+            if sock is not None:
+                sock.close()
+            sock = None
+        else:
+            # Blocks of deleted files.  Copies stored again since they
+            # were deleted, like content addressed blocks uploaded again,
+            # are kept.  Their space is reclaimed by compaction
+            before = sent - p.getAge()
+            for blockid in delete:
+                store.delete(blockid, before)
+            removed = delete
+
+        time.sleep(HEARTBEAT_INTERVAL)
+
+
+def compactor(store):
+    """Reclaims the space of deleted blocks every COMPACT_INTERVAL seconds"""
+
+    while True:
+        time.sleep(COMPACT_INTERVAL)
+        store.compact()
+
+
+def collector(store, meta_ip, meta_port, data_ip, data_port):
+    """Every GC_INTERVAL seconds asks the metadata server which of the
+        stored blocks no file uses, and removes the ones that were already
+        unused GC_GRACE seconds before, unless they were stored after the
+        oldest upload still running started.  Catches what the deletion
+        queue misses, like the blocks of uploads that never finished.
+    """
+
+    p = Packet()
+    suspects = {}
+    while True:
+        time.sleep(GC_INTERVAL)
+
+        try:
+            with socket.create_connection((meta_ip, meta_port)) as sock:
+                blockids = store.blocks()
+                sent = time.monotonic()
+                p.BuildBlockReportPacket(data_ip, data_port, len(blockids), orphans=True)
+                p.SendPacket(sock, EncodeBlockIDs(blockids))
+                p.RecvPacket(sock)
+                if p.getStatus() != "ACK":
+                    continue
+                orphans = DecodeBlockIDs(recvall(sock, p.datalen))
+        except OSError:
+            continue
+
+        # Remember since when every unused block is unused
+        now = time.monotonic()
+        suspects = {blockid: suspects.get(blockid, now) for blockid in orphans}
+        before = sent - p.getAge()
+        removed = sum(store.delete(blockid, before) for blockid, since in suspects.items()
+                      if now - since >= GC_GRACE)
+        if suspects:
+            log.info("Garbage collection: %d unused blocks, %d removed",
+                     len(suspects), removed)
+
+
+class Scrubber:
+    """Reads back every stored block, at most SCRUB_RATE bytes per second,
+        and checks it against its checksum.  Corrupt blocks are reported
+        to the metadata server and replaced by a good replica from another
+        data node.  Blocks a client found corrupt are checked right away.
+    """
+
+    def __init__(self, store, meta_addr, node_addr):
+        self.store = store
+        self.meta_addr = meta_addr
+        self.node_addr = node_addr
+        self.repairing = set()
+        self.lock = threading.Lock()
+
+    def run(self):
+        while True:
+            for blockid in self.store.blocks():
+                time.sleep(self.verify(blockid) / SCRUB_RATE)
+            time.sleep(SCRUB_INTERVAL)
+
+    def verify(self, blockid):
+        """Checks a block against its checksum and repairs it if it is
+            corrupt.  A good block stored without the sums of its pieces
+            gets them.  Returns the number of bytes read.
+        """
+
+        try:
+            with self.store.reader(blockid) as (fd, offset, length, _, _, crc, sums):
+                ok = checksum(fd, offset, length) == crc
+        except FileNotFoundError:
+            # Deleted meanwhile
+            return 0
+
+        if ok and sums is None:
+            try:
+                self.store.upgrade(blockid)
+            except ValueError:
+                ok = False
+        if not ok:
+            self.report(blockid)
+        return length
+
+    def check(self, blockid):
+        """Verifies a block a client found corrupt, in the background"""
+
+        with self.lock:
+            if blockid in self.repairing:
+                return
+        threading.Thread(target=self.verify, args=(blockid,), daemon=True).start()
+
+    def report(self, blockid):
+        """Repairs a corrupt block in the background, once at a time"""
+
+        with self.lock:
+            if blockid in self.repairing:
+                return
+            self.repairing.add(blockid)
+        threading.Thread(target=self.repair, args=(blockid,), daemon=True).start()
+
+    def repair(self, blockid):
+        """Asks the metadata server which data nodes have a good replica of
+            blockid and copies it from the first one that answers, checking
+            it on the way.
+        """
+
+        log.warning("Corrupt block %s", blockid)
+        try:
+            p = Packet()
+            with socket.create_connection(self.meta_addr) as sock:
+                p.BuildCorruptBlockPacket(*self.node_addr, blockid)
+                p.SendPacket(sock)
+                p.RecvPacket(sock)
+            sources = p.getDataNodes() if p.getStatus() == "ACK" else []
+
+            for address, port in sources or []:
+                try:
+                    with socket.create_connection((address, port)) as peer:
+                        p.BuildGetDataBlockPacket(blockid)
+                        p.SendPacket(peer)
+                        size = p.RecvPacket(peer)
+                        if p.getStatus() == "NAK":
+                            continue
+
+                        codec = p.getCodec() or "none"
+                        crc = p.getChecksum()
+                        with self.store.writer(blockid, size, CODECS[codec],
+                                               p.getBlockLength() or size) as (fd, offset, check):
+                            sums = []
+                            got, _ = recvfile(peer, size, fd, offset, sums=sums)
+                            if got != crc:
+                                raise ValueError("Checksum mismatch")
+                            check(got, pack_sums(sums))
+                    log.info("Repaired block %s from %s:%d", blockid, address, port)
+                    return
+                except (OSError, ValueError):
+                    continue
+
+            log.error("No good replica of block %s", blockid)
+        except OSError:
+            log.error("Could not report block %s", blockid)
+        finally:
+            with self.lock:
+                self.repairing.discard(blockid)
+
+
 class DataNodeTCPHandler(socketserver.BaseRequestHandler):
 
+    def downstream(self, address, port):
+        """Returns this connection's socket to the next data node of a
+            pipeline, opening it the first time.
+        """
+
+        if (address, port) not in self.next_nodes:
+            sock = socket.create_connection((address, port))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.next_nodes[(address, port)] = sock
+        return self.next_nodes[(address, port)]
+
+    def drop_downstream(self, address, port):
+        """Closes a failed connection to the next data node"""
+
+        sock = self.next_nodes.pop((address, port), None)
+        if sock is not None:
+            sock.close()
+
     def handle_put(self, p):
-        """Receives a block of data from a copy client, and 
+        """Receives a block of data from a copy client, and
             saves it with an unique ID.  The ID is sent back to the
             copy client.
+            If the packet has a pipeline the block is forwarded to the next
+            data node in it while it is written here (chain replication),
+            and the response lists every data node that stored it.
+            Compressed blocks are stored as they come, with their codec
+            and length decompressed.  A block that does not match the
+            checksum of the client is not stored and NAK is sent back.
         """
 
-        # Tell copy client that data node is ready to recieve block
-        self.request.send(b"OK")
+        # Generates an unique block id, or keeps the one given by the
+        # previous data node of the pipeline.
+        blockid = p.getBlockID() if "blockid" in p.packet else str(uuid1())
+        size = p.datalen
+        codec = p.getCodec() or "none"
+        blen = p.getBlockLength() or size
+        expected = p.getChecksum()
+
+        # Start forwarding the block to the next data node, if any
+        pipeline = p.getPipeline()
+        forward = None
+        if pipeline:
+            try:
+                forward = self.downstream(*pipeline[0])
+                fp = Packet()
+                fp.BuildPutBlockPacket(pipeline[1:], blockid, codec, blen, expected)
+                forward.sendall(fp.getFrame(size))
+            except OSError:
+                self.drop_downstream(*pipeline[0])
+                forward = None
+
+        def disk_write(seconds):
+            metrics.observe("disk.write", seconds)
+            tracing.annotate(disk_write_ms=round(seconds * 1000, 3))
+
+        # Stream exactly the block bytes that follow the packet into room
+        # reserved for it in the active segment, and down the pipeline.
+        # A block damaged on the way is left out of the index.
+        damaged = False
+        try:
+            with self.server.store.writer(blockid, size, CODECS[codec],
+                                          blen) as (fd, offset, check):
+                sums = []
+                crc, forwarded = recvfile(self.request, size, fd, offset,
+                                          forward=forward, timer=disk_write,
+                                          sums=sums)
+                if expected is not None and crc != expected:
+                    raise ValueError("Checksum mismatch")
+                check(crc, pack_sums(sums))
+        except ValueError:
+            damaged = True
+        load.add(size)
+
+        # Collect the data nodes down the pipeline that stored the block
+        replicas = [list(self.server.node_addr)]
+        if forward is not None:
+            try:
+                if not forwarded:
+                    raise ConnectionError("Forwarding failed")
+                fp.RecvPacket(forward)
+                replicas += [list(node) for node in fp.getReplicas()]
+            except (OSError, ValueError):
+                self.drop_downstream(*pipeline[0])
+
+        # Send back blockid and where it is stored
+        if damaged:
+            p.BuildStatusPacket("NAK")
+        else:
+            p.BuildBlockIDResponse(blockid, replicas)
+        p.SendPacket(self.request)
+
+    def send_block(self, p, blockid, rng=None):
+        """Sends blockid, or the (offset, length) range rng of it, as one
+            response frame.  Answers NAK if the block is not here.  Returns
+            the number of block bytes sent.
+        """
 
-        # Generates an unique block id.
-        blockid = str(uuid1())
+        # The block bytes are not read here.  Whole blocks go with their
+        # checksum and ranges with the sums of the pieces that cover them,
+        # which the client checks, and the scrubber finds the blocks that
+        # went bad at rest
+        with ExitStack() as stack:
+            try:
+                fd, start, size, codec, blen, crc, sums = stack.enter_context(
+                    self.server.store.reader(blockid))
+            except FileNotFoundError:
+                p.BuildStatusPacket("NAK")
+                p.SendPacket(self.request)
+                return 0
+
+            # Work out the range to send, the whole block if none was
+            # requested.  Compressed blocks are sent whole, the client
+            # decompresses them and takes the range.
+            if codec:
+                offset, length = 0, size
+            else:
+                offset, length = rng or (0, size)
+                offset = min(offset, size)
+                if length is None or offset + length > size:
+                    length = size - offset
+
+            # A range is widened to whole pieces, from the start of the
+            # first one that covers it to the end of the last one, and
+            # goes with their sums.  Blocks stored before there were sums
+            # have none until the scrubber gets to them.
+            whole = offset == 0 and length == size
+            skip = 0
+            if whole or sums is None:
+                sums = None
+            else:
+                first, last = offset // CRC_CHUNK, pieces(offset + length)
+                skip = offset - first * CRC_CHUNK
+                offset -= skip
+                length = min(size, last * CRC_CHUNK) - offset
+                sums = unpack_sums(sums, first, last)
+
+            # Send back block bytes after the response header, straight
+            # from the segment to the socket with sendfile.  The checksum
+            # goes along when the whole block is sent, for the client to
+            # check it
+            p.BuildBlockIDResponse(blockid, codec=NAMES[codec], blen=blen,
+                                   crc=crc if whole else None, sums=sums, skip=skip)
+            with metrics.timer("send.block"):
+                p.SendFilePacket(self.request, fd, start + offset, length)
+
+        # sendfile goes around the counting socket
+        metrics.count("bytes_out", length)
+        return length
 
-        # Open the file for the new data block.
-        fd = open(f"{argv[3]}/{blockid}.dat", "wb+")
+    def handle_get(self, p):
 
-        # Recieve 16kb max block and write to file
-        fd.write(self.request.recv(16384))
+        # Get the block id from the packet and send the block
+        load.add(self.send_block(p, p.getBlockID(), p.getRange()))
 
-        # Close file
-        fd.close()
+    def handle_mget(self, p):
 
-        # Send back blockid
-        self.request.sendall(blockid.encode())
+        # Send the blocks back in the order they were asked for, one frame
+        # each.  The next blocks are read from disk into the page cache
+        # while the socket drains, so the disk and the network are busy at
+        # the same time instead of taking turns.
+        ranges = p.getRanges()
+        for blockid, _, _ in ranges[:READAHEAD]:
+            self.server.store.prefetch(blockid)
 
-    def handle_get(self, p):
+        for i, (blockid, offset, length) in enumerate(ranges):
+            if i + READAHEAD < len(ranges):
+                self.server.store.prefetch(ranges[i + READAHEAD][0])
+            rng = (offset, length) if offset or length is not None else None
+            load.add(self.send_block(p, blockid, rng))
 
-        # Get the block id from the packet
-        blockid = p.getBlockID()
+    def handle_check(self, p):
 
-        # Read the file with the block id data
-        # Send it back to the copy client.
-        fd = open(f"{argv[3]}/{blockid}.dat", "rb")
+        # A client read a corrupt block from here, check it and repair it
+        # in the background if it really is
+        self.server.scrubber.check(p.getBlockID())
+        p.BuildStatusPacket("ACK")
+        p.SendPacket(self.request)
 
-        # Send back block bytes
-        self.request.send(fd.read())
+    def handle_stats(self, p):
+
+        # Send back the metrics of this data node, with what its block
+        # store holds
+        stats = metrics.snapshot()
+        stats["gauges"].update(self.server.store.stats())
+        stats["gauges"]["transfers"] = load.inflight
+        p.BuildStatsResponse(stats)
+        p.SendPacket(self.request)
 
     def handle(self):
 
-        # Recieve packet
-        msg = b""
-        while True:
-            buffer = self.request.recv(4096)
-            msg += buffer
-            if getsizeof(buffer) < 4096:
-                break
+        p = Packet()
 
-        print(msg, type(msg))
+        # Connections to the next data nodes of replication pipelines
+        self.next_nodes = {}
 
-        # Parse message as Packet
-        p = Packet()
-        p.DecodePacket(msg)
+        # Count the bytes in and out of this connection while it is open
+        self.request = CountingSocket(self.request)
+        with metrics.connection():
+            # Serve requests back to back on this connection until the
+            # client closes it
+            while p.RecvPacket(self.request) is not None:
+                log.debug("Packet %s", p.packet)
+
+                # Run command in p, timed, counted and traced
+                cmd = p.getCommand()
+                with metrics.request(cmd, self.request), \
+                        tracing.join(p.getTrace(), f"data-node {cmd}", p.timing):
+                    if cmd == "put":
+                        with load.transfer():
+                            self.handle_put(p)
+
+                    elif cmd == "get":
+                        with load.transfer():
+                            self.handle_get(p)
 
-        # Run command in p
-        cmd = p.getCommand()
-        if cmd == "put":
-            self.handle_put(p)
+                    elif cmd == "mget":
+                        with load.transfer():
+                            self.handle_mget(p)
 
-        elif cmd == "get":
-            self.handle_get(p)
+                    elif cmd == "stats":
+                        self.handle_stats(p)
 
+                    elif cmd == "check":
+                        self.handle_check(p)
+
+        for sock in self.next_nodes.values():
+            sock.close()
 
 if __name__ == "__main__":
 
@@ -143,8 +585,36 @@ if __name__ == "__main__":
     except:
         usage()
 
+    # Open the block store, moving blocks kept one per file into segments.
+    # Its index is loaded from disk, or rebuilt from the segments if lost
+    store = BlockStore(DATA_PATH)
+
+    # Spans of this data node are logged under its port
+    tracing.setName(f"data-node-{PORT}")
+
     register("localhost", META_PORT, HOST, PORT)
-    server = socketserver.TCPServer((HOST, PORT), DataNodeTCPHandler)
+    report("localhost", META_PORT, HOST, PORT, store)
+
+    # Keep telling the metadata server this node is alive, and its load
+    threading.Thread(target=heartbeat, daemon=True,
+                     args=("localhost", META_PORT, HOST, PORT, DATA_PATH, store)).start()
+    threading.Thread(target=compactor, args=(store,), daemon=True).start()
+
+    # Remove the blocks no file uses, left by uploads that did not finish
+    threading.Thread(target=collector, daemon=True,
+                     args=(store, "localhost", META_PORT, HOST, PORT)).start()
+
+    # Keep checking the stored blocks for corruption
+    scrubber = Scrubber(store, ("localhost", META_PORT), (HOST, PORT))
+    threading.Thread(target=scrubber.run, daemon=True).start()
+
+    # Clients keep their connection open across requests, so every
+    # connection gets its own thread
+    socketserver.ThreadingTCPServer.daemon_threads = True
+    server = socketserver.ThreadingTCPServer((HOST, PORT), DataNodeTCPHandler)
+    server.node_addr = (HOST, PORT)
+    server.store = store
+    server.scrubber = scrubber
 
     # Activate the server; this will keep running until you
     # interrupt the program with Ctrl-C
@@ -0,0 +1,140 @@
+###############################################################################
+#
+# Filename: inode_cache.py
+# Author: Jose R. Ortiz and Daniel Suazo
+#
+# Description:
+# 	In memory inode cache for the metadata server.  Keeps the block map
+# 	of recently read files in a compact, array backed form together with
+# 	the encoded get response, so repeat lookups of popular files touch
+# 	neither SQLite nor the packet encoder.  Bounded in memory, least
+# 	recently used files are evicted first.
+#
+
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+import threading
+
+# Default memory bound of the cache, in bytes
+CACHE_SIZE = 64 << 20
+
+
+class InodeEntry:
+    """Block map of one file.  Blocks are kept as parallel arrays (node
+        index, offset, length) plus one buffer with all the chunk ids,
+        instead of a list of tuples.
+    """
+
+    __slots__ = ("fsize", "nodes", "nidx", "offsets", "lengths", "cids",
+                 "cends", "frame", "size")
+
+    def __init__(self, fsize, blocks, frame):
+        self.fsize = fsize
+        self.frame = frame
+
+        nodes = {}
+        self.nidx = array("H")
+        self.offsets = array("Q")
+        self.lengths = array("L")
+        self.cends = array("L")
+        cids = bytearray()
+        for address, port, cid, offset, length in blocks:
+            self.nidx.append(nodes.setdefault((address, port), len(nodes)))
+            self.offsets.append(offset)
+            self.lengths.append(length)
+            cids += cid.encode()
+            self.cends.append(len(cids))
+        self.nodes = list(nodes)
+        self.cids = bytes(cids)
+
+        # Approximate memory used by the entry
+        self.size = len(frame) + len(self.cids) + 64 * len(self.nodes) + sum(
+            a.itemsize * len(a)
+            for a in (self.nidx, self.offsets, self.lengths, self.cends))
+
+    def getBlocks(self, first=0, last=None):
+        """Returns the blocks [first, last) as (address, port, chunk id,
+            offset, length) tuples.
+        """
+
+        if last is None:
+            last = len(self.offsets)
+
+        blocks = []
+        for i in range(first, last):
+            address, port = self.nodes[self.nidx[i]]
+            start = self.cends[i - 1] if i else 0
+            cid = self.cids[start:self.cends[i]].decode()
+            blocks.append((address, port, cid, self.offsets[i], self.lengths[i]))
+        return blocks
+
+    def getRange(self, offset, length):
+        """Returns the blocks that hold the bytes [offset, offset + length),
+            found with a binary search over the block offsets.
+        """
+
+        # Replicas of a block share its offset, start at the first one
+        first = max(bisect_right(self.offsets, offset) - 1, 0)
+        if first < len(self.offsets):
+            first = bisect_left(self.offsets, self.offsets[first])
+        last = bisect_right(self.offsets, offset + length - 1) if length > 0 else first
+        return self.getBlocks(first, max(first, last))
+
+
+class InodeCache:
+    """LRU cache of InodeEntry objects keyed by file name."""
+
+    def __init__(self, maxsize=CACHE_SIZE):
+        self.maxsize = maxsize
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        # Bumped by every invalidation.  An entry built from a database
+        # read that started before an invalidation is not stored, so a
+        # stale block map can not get in.
+        self.version = 0
+
+    def Get(self, fname):
+        """Returns the entry of fname and marks it as recently used, None
+            if it is not cached.
+        """
+
+        with self.lock:
+            entry = self.entries.get(fname)
+            if entry is not None:
+                self.entries.move_to_end(fname)
+            return entry
+
+    def Put(self, fname, entry, version):
+        """Stores the entry of fname, built from a database read started
+            at cache version, evicting least recently used entries to stay
+            under maxsize.
+        """
+
+        if entry.size > self.maxsize:
+            return
+
+        with self.lock:
+            if version != self.version:
+                return
+
+            old = self.entries.pop(fname, None)
+            if old is not None:
+                self.size -= old.size
+            self.entries[fname] = entry
+            self.size += entry.size
+
+            while self.size > self.maxsize:
+                _, old = self.entries.popitem(last=False)
+                self.size -= old.size
+
+    def Invalidate(self, fname):
+        """Drops fname from the cache, on put, new blocks or delete."""
+
+        with self.lock:
+            self.version += 1
+            old = self.entries.pop(fname, None)
+            if old is not None:
+                self.size -= old.size
@@ -10,15 +10,17 @@
 import socket
 from sys import argv
 from Packet import Packet
+import tracing
 
 
 def usage():
-    print(f"Usage: python {argv[0]} <server>:<port, default=8000>")
+    print(f"Usage: python {argv[0]} <server>:<port, default=8000> <directory, default=/> <glob, optional>")
     exit(0)
 
 
-def client(ip, port):
-    # Contacts the metadata server and ask for list of files.
+def client(ip, port, path="/", pattern=None):
+    # Contacts the metadata server and ask for the files of a directory,
+    # one page at a time.
 
     # Create socket and connect to meta data server
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -27,40 +29,43 @@ def client(ip, port):
     except:
         exit("Could not connect to Metadata Server. Exiting")
 
-    # Create list packet and encode it
+    prefix = path.rstrip("/") + "/"
     pack = Packet()
-    pack.BuildListPacket()
-    encoded_packet = pack.getEncodedPacket()
+    cursor = None
+    while True:
+        # Create list packet for the next page
+        pack.BuildListPacket(path, pattern, cursor)
 
-    # Send list packet
-    try:
-        sock.send(encoded_packet)
-    except Exception as e:
-        exit(e)
-
-    # Recieve the response packet as a byte string and decode it into pack
-    message = b""
-    while buffer := sock.recv(1024):
-        message += buffer
+        # Send list packet
+        try:
+            pack.SendPacket(sock)
+        except Exception as e:
+            exit(e)
 
-    if message != b"NAK":
+        # Recieve the response frame and decode it into pack
         try:
-            # If packet formatter properly
-            pack.DecodePacket(message)
+            pack.RecvPacket(sock)
         except Exception as e:
-            # If other error
-            print(type(message))
+            # If packet not formatted properly
             exit(e)
-    else:
-        # If Internal Server Error
-        exit("Error in returned packet")
 
-    # Extract files
-    files = pack.getFileArray()
+        if pack.getStatus() == "NAK":
+            # If Internal Server Error
+            exit("Error in returned packet")
+
+        if pack.getStatus() == "NFOUND":
+            exit(f"No such directory {path}")
 
-    # Print out files and size
-    for name, size in files:
-        print(f"{name} {size} bytes")
+        # Print out the page as soon as it arrives, directories and then
+        # files and size
+        for name in pack.getDirArray():
+            print(f"{prefix}{name}/")
+        for name, size in pack.getFileArray():
+            print(f"{prefix}{name} {size} bytes")
+
+        cursor = pack.getCursor()
+        if cursor is None:
+            break
 
     # Close socket
     sock.close()
@@ -84,4 +89,8 @@ if __name__ == "__main__":
     if not ip:
         usage()
 
-    client(ip, port)
+    path = argv[2] if len(argv) > 2 else "/"
+    pattern = argv[3] if len(argv) > 3 else None
+
+    with tracing.start("ls", path=path):
+        client(ip, port, path, pattern)
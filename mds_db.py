@@ -7,57 +7,327 @@
 # 	MySQL support library for the DFS project. Database info for the
 #       metadata server.
 #
+# 	One mds_db object is shared by all the metadata server threads.  The
+# 	database runs in WAL mode: lookups use a small pool of reader
+# 	connections and never wait for a writer, while all writes go through a
+# 	single writer thread that commits them in groups (one fsync for every
+# 	write that was waiting).
+#
 
+import queue
 import sqlite3
+import threading
+from concurrent.futures import Future
+from contextlib import contextmanager
+import time
+
+from metrics import Metrics, getLogger
+
+log = getLogger("meta-data")
+
+# Version of the database schema created by createdb.py
+SCHEMA_VERSION = 9
+
+# Block size used by the DFS before block offsets were stored
+LEGACY_BLOCK_SIZE = 16384
+
+# Number of reader connections, and most writes committed together
+READERS = 4
+GROUP_COMMIT = 256
+
+# Prepared statements kept by every connection
+CACHED_STATEMENTS = 256
+
+# Most values bound in one "in (...)" query
+MAX_VARIABLES = 500
+
+# Directory id of the root directory
+ROOT_DIR = 1
+
+# Seconds a deleted block waits in the deletion queue before data nodes
+# are told to remove it, so an upload that found it already stored can
+# still claim it
+DELETE_DELAY = 60
+
+# Seconds a file without blocks counts as an upload still running, whose
+# blocks are not collected as unused
+UPLOAD_TIMEOUT = 24 * 3600
+
+
+def SplitPath(path):
+    """Returns the names in a DFS path, "/a/b.txt" is ["a", "b.txt"]"""
+
+    return [part for part in path.split("/") if part]
 
 
 class mds_db:
 
     def __init__(self, db_name):
-        self.c = None
         self.db_name = db_name
         self.conn = None
+        self.readers = None
+        self.writes = None
+        self.writer = None
+
+        # Cache of (address, port) -> nid of the data nodes
+        self.nodes = {}
+
+        # Time spent in queries, replaced by the metrics of the server
+        self.metrics = Metrics()
+
+    def _Open(self):
+        """Opens a connection that can be shared between threads"""
+
+        conn = sqlite3.connect(self.db_name, check_same_thread=False,
+                               isolation_level=None,
+                               cached_statements=CACHED_STATEMENTS)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=FULL")
+        return conn
 
     def Connect(self):
         """Connect to the database file"""
         try:
-            self.conn = sqlite3.connect(self.db_name)
-            self.c = self.conn.cursor()
-            self.conn.isolation_level = None
+            self.conn = self._Open()
+            self.readers = queue.Queue()
+            for _ in range(READERS):
+                self.readers.put(self._Open())
+
+            # Start the writer thread
+            self.writes = queue.Queue()
+            self.writer = threading.Thread(target=self._Writer, daemon=True)
+            self.writer.start()
             return 1
         except:
             return 0
 
     def Close(self):
-        """Close cursor to the database"""
+        """Close the connections to the database"""
         try:
-            # self.conn.commit()
-            self.c.close()
+            # Let the writer finish the writes already queued
+            self.writes.put(None)
+            self.writer.join()
+            self.conn.close()
+            while not self.readers.empty():
+                self.readers.get().close()
             return 1
         except:
             return 0
 
+    @contextmanager
+    def _Reader(self):
+        """Borrows a reader connection from the pool and yields a cursor"""
+
+        conn = self.readers.get()
+        try:
+            with self.metrics.timer("db.read"):
+                yield conn.cursor()
+        finally:
+            self.readers.put(conn)
+
+    def _Writer(self):
+        """Writer thread.  Takes every write waiting in the queue, runs each
+            one inside its own savepoint, so a failed write is undone
+            without affecting the others, and commits them all at once.
+        """
+
+        c = self.conn.cursor()
+        running = True
+        while running:
+            group = [self.writes.get()]
+            while len(group) < GROUP_COMMIT:
+                try:
+                    group.append(self.writes.get_nowait())
+                except queue.Empty:
+                    break
+            if None in group:
+                running = False
+                group = [w for w in group if w is not None]
+            if not group:
+                continue
+
+            start = time.perf_counter()
+            try:
+                results = self._WriteGroup(c, group)
+            except Exception as e:
+                # The transaction itself failed, e.g. the database is busy
+                # with another process, the disk is full or an I/O error.
+                # Nothing of the group is written, so every write in it
+                # fails, and the thread goes on with the next group
+                try:
+                    if self.conn.in_transaction:
+                        c.execute("ROLLBACK")
+                except Exception:
+                    pass
+                results = [(future, None, e) for future, _, _ in group]
+            self.metrics.observe("db.commit", time.perf_counter() - start)
+            self.metrics.count("db.writes", len(group))
+
+            # Only answer once the group is durable
+            for future, result, error in results:
+                if error is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(error)
+
+    def _WriteGroup(self, c, group):
+        """Runs a group of writes in one transaction and commits it.
+            Returns the (future, result, error) of every write.
+        """
+
+        results = []
+        c.execute("BEGIN IMMEDIATE")
+        for future, fn, args in group:
+            c.execute("SAVEPOINT op")
+            try:
+                results.append((future, fn(c, *args), None))
+                c.execute("RELEASE op")
+            except Exception as e:
+                c.execute("ROLLBACK TO op")
+                c.execute("RELEASE op")
+                results.append((future, None, e))
+        c.execute("COMMIT")
+        return results
+
+    def _Write(self, fn, *args):
+        """Runs fn(cursor, *args) in the writer thread and returns its
+            result once it is committed.
+        """
+
+        future = Future()
+        with self.metrics.timer("db.write"):
+            self.writes.put((future, fn, args))
+            return future.result()
+
+    def Migrate(self):
+        """Brings an existing database up to SCHEMA_VERSION.
+            Version 1 adds the sequence number, offset and length of every
+            block and the (fid, seq) and (fid, boffset) indexes.  Blocks
+            stored before it are numbered in insertion order.
+            Version 2 adds the block size of every file.
+            Version 3 adds the replication factor of every file.
+            Version 4 adds the chunk table, which counts the blocks that
+            reference every chunk stored on a data node, so the same chunk
+            can be shared by many blocks.
+            Version 5 adds the compression codec of every file.
+            Version 6 adds the CRC32 of every block.
+            Version 7 adds the dir table, with the directories of the
+            namespace, and the directory and base name of every file.
+            Version 8 adds the deleteq table, the deletion queue of the
+            blocks data nodes have to remove.
+            Version 9 adds the time every file was created.
+        """
+
+        return self._Write(self._Migrate)
+
+    def _Migrate(self, c):
+
+        c.execute("PRAGMA user_version")
+        version = c.fetchone()[0]
+        if version >= SCHEMA_VERSION:
+            return
+
+        if version < 1:
+            c.execute("ALTER TABLE block ADD COLUMN seq INTEGER NOT NULL DEFAULT 0")
+            c.execute("ALTER TABLE block ADD COLUMN boffset INTEGER NOT NULL DEFAULT 0")
+            c.execute("ALTER TABLE block ADD COLUMN blen INTEGER NOT NULL DEFAULT 0")
+
+            # Number the blocks of every file in the order they were added
+            c.execute("select fid, fsize from inode")
+            for fid, fsize in c.fetchall():
+                c.execute("select bid from block where fid=? order by bid", (fid,))
+                rows = []
+                for seq, (bid,) in enumerate(c.fetchall()):
+                    offset = seq * LEGACY_BLOCK_SIZE
+                    length = min(LEGACY_BLOCK_SIZE, fsize - offset)
+                    rows.append((seq, offset, length, bid))
+                c.executemany(
+                    "update block set seq=?, boffset=?, blen=? where bid=?", rows)
+
+            c.execute("CREATE INDEX blockfs ON block(fid, seq)")
+            c.execute("CREATE INDEX blockfo ON block(fid, boffset)")
+
+        if version < 2:
+            c.execute(
+                f"ALTER TABLE inode ADD COLUMN bsize INTEGER NOT NULL DEFAULT {LEGACY_BLOCK_SIZE}")
+
+        if version < 3:
+            c.execute("ALTER TABLE inode ADD COLUMN repl INTEGER NOT NULL DEFAULT 1")
+
+        if version < 4:
+            c.execute("""CREATE TABLE chunk (cid TEXT NOT NULL, nid INTEGER NOT NULL, blen INTEGER NOT NULL DEFAULT 0, refs INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (cid, nid))""")
+            c.execute("""insert into chunk (cid, nid, blen, refs) select cid, nid, max(blen), count(*) from block group by cid, nid""")
+
+            # A chunk can now be in many blocks of the same data node
+            c.execute("DROP INDEX blocknc")
+            c.execute("CREATE INDEX blocknc ON block(nid, cid)")
+
+        if version < 5:
+            c.execute("ALTER TABLE inode ADD COLUMN codec TEXT NOT NULL DEFAULT 'none'")
+
+        if version < 6:
+            c.execute("ALTER TABLE block ADD COLUMN crc INTEGER")
+
+        if version < 7:
+            c.execute("""CREATE TABLE dir (did INTEGER PRIMARY KEY ASC AUTOINCREMENT, parent INTEGER NOT NULL DEFAULT 0, name TEXT NOT NULL DEFAULT "")""")
+            c.execute("CREATE UNIQUE INDEX dirpn ON dir(parent, name)")
+            c.execute("INSERT INTO dir (did, parent, name) VALUES (?, 0, '')", (ROOT_DIR,))
+            c.execute(f"ALTER TABLE inode ADD COLUMN did INTEGER NOT NULL DEFAULT {ROOT_DIR}")
+            c.execute("ALTER TABLE inode ADD COLUMN name TEXT NOT NULL DEFAULT ''")
+
+            # Create the directories of every file first, and then put
+            # every file in its directory.  The flat namespace allowed
+            # files like /a next to /a/b, and paths with no name, so the
+            # files whose name is taken are renamed to name~fid
+            c.execute("select fid, fname from inode order by fid")
+            files = c.fetchall()
+            for fid, fname in files:
+                self._MakeDirs(c, SplitPath(fname)[:-1])
+            for fid, fname in files:
+                *parents, name = SplitPath(fname) or [""]
+                did = self._FindDir(c, parents)
+                new = fname
+                while True:
+                    c.execute("""select 1 from dir where parent=? and name=? union all select 1 from inode where (did=? and name=?) or (fname=? and fid!=?)""",
+                              (did, name, did, name, new, fid))
+                    if name and c.fetchone() is None:
+                        break
+                    name = f"{name or 'file'}~{fid}"
+                    new = "/" + "/".join(parents + [name])
+                if new != fname:
+                    log.warning("Renamed %r to %r, its name is taken", fname, new)
+                c.execute("update inode set fname=?, did=?, name=? where fid=?",
+                          (new, did, name, fid))
+
+            c.execute("CREATE INDEX inodedn ON inode(did, name)")
+
+        if version < 8:
+            c.execute("""CREATE TABLE deleteq (nid INTEGER NOT NULL, cid TEXT NOT NULL, queued REAL NOT NULL DEFAULT 0, PRIMARY KEY (nid, cid))""")
+
+        if version < 9:
+            c.execute("ALTER TABLE inode ADD COLUMN created REAL NOT NULL DEFAULT 0")
+            c.execute("CREATE INDEX inodec ON inode(created)")
+
+        c.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
     def AddDataNode(self, address, port):
         """Adds new data node to the metadata server
             Receives IP address and port
             I.E. the information to connect to the data node
         """
 
-        query = f"""INSERT INTO dnode (address, port) VALUES ("{address}", {port})"""
+        nid = self._Write(self._AddDataNode, address, port)
+        if nid:
+            self.nodes[(address, port)] = nid
+        return nid
+
+    def _AddDataNode(self, c, address, port):
+
+        query = """INSERT INTO dnode (address, port) VALUES (?, ?)"""
         try:
-            # print(type(self.c))
-            # print(dir(self.c))
-            # print(query)
-            self.c.execute(query)
-            # print(self.c.lastrowid)
-            return self.c.lastrowid
+            c.execute(query, (address, port))
+            return c.lastrowid
         except sqlite3.IntegrityError as e:
-            # print("type:", type(e))
-            # print("dir:", dir(e))
-            # print("e:", e)
-            # print(e.args[0])
-            # print("error in AddDataNode")
-            # print(e.args[0])
             if e.args[0].split()[0].strip() == "UNIQUE":
                 return 0
             else:
@@ -67,16 +337,29 @@ class mds_db:
         """Check if node is in database and returns name, address, port
             for connection.
         """
-        query = f"""select nid from dnode where address="{address}" and port={port}"""
+        with self._Reader() as c:
+            return self._CheckNode(c, address, port)
+
+    def _CheckNode(self, c, address, port):
+
+        query = """select nid from dnode where address=? and port=?"""
         try:
-            self.c.execute(query)
+            c.execute(query, (address, port))
+            return c.fetchone()[0]
         except:
             return None
-        # print(self.c.fetchone())
-        try:
-            return self.c.fetchone()[0]
-        except TypeError:
-            return None
+
+    def _NodeIDs(self, c, addresses):
+        """Returns the nid of every (address, port) in addresses from the
+            node cache.  The cache is reloaded from the dnode table once if
+            a node is missing.  Raises KeyError for unknown nodes.
+        """
+
+        if not all(a in self.nodes for a in addresses):
+            c.execute("""select address, port, nid from dnode""")
+            self.nodes = {(address, port): nid for address, port, nid in c}
+
+        return [self.nodes[a] for a in addresses]
 
     def GetDataNodes(self):
         """Returns a list of data node tuples (address, port).  Usefull to know to which
@@ -84,29 +367,119 @@ class mds_db:
         """
 
         query = """select address, port from dnode where 1"""
-        self.c.execute(query)
-        return self.c.fetchall()
+        with self._Reader() as c:
+            c.execute(query)
+            return c.fetchall()
 
-    def InsertFile(self, fname, fsize):
+    def InsertFile(self, fname, fsize, bsize=LEGACY_BLOCK_SIZE, repl=1, codec="none"):
         """Create the inode attributes.  For this project the name of the
-            file and its size.
+            file, its size, the size of its blocks, how many replicas of
+            each block are kept and the codec its blocks are compressed
+            with.  Returns 0 if the path is taken, by a file or by a
+            directory, or one of its parents is a file.
         """
-        query = f"""insert into inode (fname, fsize) values ("{fname}", {fsize})"""
         try:
-            self.c.execute(query)
-            return 1
+            return self._Write(self._InsertFile, fname, fsize, bsize, repl, codec)
         except:
             return 0
 
+    def _InsertFile(self, c, fname, fsize, bsize, repl, codec):
+
+        # Create the directories of the path that do not exist yet
+        *parents, name = SplitPath(fname)
+        did = self._MakeDirs(c, parents)
+
+        # The name can not be a directory, or a file spelled differently
+        c.execute("""select 1 from dir where parent=? and name=? union all select 1 from inode where did=? and name=?""",
+                  (did, name, did, name))
+        if c.fetchone():
+            raise FileExistsError(fname)
+
+        query = """insert into inode (fname, fsize, bsize, repl, codec, did, name, created) values (?, ?, ?, ?, ?, ?, ?, ?)"""
+        c.execute(query, (fname, fsize, bsize, repl, codec, did, name, time.time()))
+        return 1
+
+    def _MakeDirs(self, c, parts):
+        """Returns the did of the directory with path parts, creating it and
+            its parents if they do not exist.  Raises FileExistsError if
+            one of them is a file.
+        """
+
+        did = ROOT_DIR
+        for part in parts:
+            c.execute("""select 1 from inode where did=? and name=?""", (did, part))
+            if c.fetchone():
+                raise FileExistsError(part)
+            c.execute("""insert or ignore into dir (parent, name) values (?, ?)""", (did, part))
+            c.execute("""select did from dir where parent=? and name=?""", (did, part))
+            did = c.fetchone()[0]
+        return did
+
+    def _FindDir(self, c, parts):
+        """Returns the did of the directory with path parts, None if it
+            does not exist.
+        """
+
+        did = ROOT_DIR
+        for part in parts:
+            c.execute("""select did from dir where parent=? and name=?""", (did, part))
+            row = c.fetchone()
+            if row is None:
+                return None
+            did = row[0]
+        return did
+
+    def ListDir(self, path, pattern=None, cursor=None, limit=1000):
+        """Lists one page of the directory path: at most limit entries, the
+            subdirectories first and then the files, each in name order,
+            through the (parent, name) and (did, name) indexes.  pattern is
+            a glob the names must match.  cursor is the one returned with
+            the previous page, None for the first page.
+            Returns (dirs, files, cursor): the names of the subdirectories,
+            (name, size) of the files and the cursor of the next page, None
+            if this is the last one.  Returns None if the directory does
+            not exist.
+        """
+
+        kind, last = cursor.split(":", 1) if cursor else ("d", "")
+        glob = " and name glob ?" if pattern else ""
+        args = (pattern,) if pattern else ()
+
+        with self._Reader() as c:
+            did = self._FindDir(c, SplitPath(path))
+            if did is None:
+                return None
+
+            dirs = []
+            if kind == "d":
+                query = f"""select name from dir where parent=? and name>?{glob} order by name limit ?"""
+                c.execute(query, (did, last) + args + (limit,))
+                dirs = [name for (name,) in c.fetchall()]
+                if len(dirs) == limit:
+                    return dirs, [], f"d:{dirs[-1]}"
+                last = ""
+
+            query = f"""select name, fsize from inode where did=? and name>?{glob} order by name limit ?"""
+            c.execute(query, (did, last) + args + (limit - len(dirs),))
+            files = c.fetchall()
+            if files and len(dirs) + len(files) == limit:
+                return dirs, files, f"f:{files[-1][0]}"
+            return dirs, files, None
+
     def GetFileInfo(self, fname):
         """ Given a filename, if the file is stored in DFS
             return its filename id and fsize.  Internal use only.
             Does not have to be accessed from the metadata server.
         """
-        query = """select fid, fsize from inode where fname="%s" """ % fname
+        with self._Reader() as c:
+            return self._GetFileInfo(c, fname)
+
+    def _GetFileInfo(self, c, fname):
+
+        query = """select fid, fsize from inode where fname=?"""
         try:
-            self.c.execute(query)
-            result = self.c.fetchone()
+            c.execute(query, (fname,))
+            result = c.fetchone()
             return result[0], result[1]
         except:
             return None, None
@@ -116,36 +489,266 @@ class mds_db:
         """File Name and Size"""
 
         query = """select fname, fsize from inode where 1"""
-        self.c.execute(query)
-        return self.c.fetchall()
+        with self._Reader() as c:
+            c.execute(query)
+            return c.fetchall()
 
-    def AddBlockToInode(self, fname, blocks):
+    def AddBlockToInode(self, fname, blocks, crcs=None, refs=None):
         """Once the Inode was created with the file's attribute
-            and the data copied to the data nodes.  The inode is 
+            and the data copied to the data nodes.  The inode is
             updated to point to the data blocks. So this function receives
-            the filename and a list of tuples with (node id, chunk id)
+            the filename and a list of tuples with (address, port, chunk id,
+            offset, length) in file order.  The replicas of a block are
+            consecutive entries with the same offset, and share its seq.
+            Chunks already stored, like the ones found with FindChunks,
+            get one more reference.  crcs has the CRC32 of every block, or
+            None where the client does not know it.  refs has the indexes
+            of the blocks the client did not upload but found stored.
+            All the blocks are added in one transaction, or none of them:
+            returns 1 once they are committed, None if the file does not
+            exist, the chunk ids of the blocks in refs that are no longer
+            stored, to be uploaded again, and 0 on any other error.
         """
-        fid = self.GetFileInfo(fname)[0]
+        try:
+            return self._Write(self._AddBlockToInode, fname, blocks, crcs, refs)
+        except:
+            return 0
+
+    def _AddBlockToInode(self, c, fname, blocks, crcs, refs):
+
+        fid = self._GetFileInfo(c, fname)[0]
         if not fid:
             return None
-        for address, port, chunkid in blocks:
-            nid = self.CheckNode(address, port)
-            if nid:
-                query = f"""insert into block (nid, fid, cid) values ({nid}, {fid}, "{chunkid}")"""
-                self.c.execute(query)
+
+        # Resolve every data node once, before inserting anything
+        nids = self._NodeIDs(c, [(address, port) for address, port, *_ in blocks])
+
+        # Blocks found stored may have been deleted since.  Chunks still
+        # in the deletion queue can be claimed until DELETE_DELAY is over,
+        # after that the data node may have removed them already
+        gone = set()
+        deadline = time.time() - DELETE_DELAY
+        for i in refs or ():
+            cid = str(blocks[i][2])
+            c.execute("""select 1 from chunk where nid=? and cid=? union all select 1 from deleteq where nid=? and cid=? and queued>=?""",
+                      (nids[i], cid, nids[i], cid, deadline))
+            if c.fetchone() is None:
+                gone.add(cid)
+        if gone:
+            return sorted(gone)
+
+        if crcs is None:
+            crcs = [None] * len(blocks)
+
+        rows = []
+        seq = -1
+        last = None
+        for nid, (_, _, chunkid, offset, length), crc in zip(nids, blocks, crcs):
+            if offset != last:
+                seq += 1
+                last = offset
+            rows.append((nid, fid, str(chunkid), seq, offset, length, crc))
+
+        query = """insert into block (nid, fid, cid, seq, boffset, blen, crc) values (?, ?, ?, ?, ?, ?, ?)"""
+        c.executemany(query, rows)
+
+        # Count the new references to every chunk
+        query = """insert into chunk (cid, nid, blen, refs) values (?, ?, ?, 1) on conflict (cid, nid) do update set refs = refs + 1"""
+        c.executemany(query, [(cid, nid, blen) for nid, _, cid, _, _, blen, _ in rows])
+
+        # Chunks of a deleted file waiting to be removed are used again
+        c.executemany("""delete from deleteq where nid=? and cid=?""",
+                      [(nid, cid) for nid, _, cid, *_ in rows])
+        return 1
+
+    def FindChunks(self, cids):
+        """Content addressed blocks use the hash of their data as chunk id.
+            Given a list of chunk ids returns a list of (address, port,
+            chunk id, 0, length) tuples, one for every data node that
+            stores one of them.
+        """
+
+        cids = list(set(cids))
+        found = []
+        with self._Reader() as c:
+            for i in range(0, len(cids), MAX_VARIABLES):
+                batch = cids[i:i + MAX_VARIABLES]
+                query = f"""select address, port, cid, 0, blen from chunk, dnode where chunk.cid in ({",".join("?" * len(batch))}) and dnode.nid = chunk.nid and chunk.refs > 0"""
+                c.execute(query, batch)
+                found += c.fetchall()
+        return found
+
+    def ReconcileBlocks(self, address, port, blockids):
+        """Compares the block ids a data node reports holding against the
+            block table.  Rows of blocks the node lost are removed, as long
+            as another replica of the block is left, so readers stop trying
+            the node for them.  Returns (lost, orphans, fnames): the number
+            of blocks the node lost, the number of reported blocks that no
+            file uses, and the names of the files with lost blocks.  None
+            if the node is not registered.
+        """
+
+        return self._Write(self._ReconcileBlocks, address, port, set(blockids))
+
+    def _ReconcileBlocks(self, c, address, port, blockids):
+
+        nid = self._CheckNode(c, address, port)
+        if not nid:
+            return None
+
+        query = """select bid, fid, seq, cid, fname from block join inode using (fid) where block.nid=?"""
+        c.execute(query, (nid,))
+        known = set()
+        lost = []
+        fnames = set()
+        for bid, fid, seq, cid, fname in c.fetchall():
+            if cid in blockids:
+                known.add(cid)
             else:
-                return 0
+                lost.append((bid, fid, seq, cid))
+                fnames.add(fname)
+
+        for bid, fid, seq, cid in lost:
+            c.execute("""select count(*) from block where fid=? and seq=? and bid!=?""",
+                      (fid, seq, bid))
+            if c.fetchone()[0]:
+                c.execute("""delete from block where bid=?""", (bid,))
+
+        # Lost chunks can not be shared by new files
+        c.executemany("""delete from chunk where cid=? and nid=?""",
+                      [(cid, nid) for _, _, _, cid in lost])
+
+        return len(lost), len(blockids - known), fnames
+
+    def DeleteFile(self, fname):
+        """Removes the inode of fname and its blocks, all at once.  Chunks
+            no other block uses are queued for deletion on their data
+            nodes.  Returns the number of chunks queued, None if the file
+            does not exist.
+        """
+
+        return self._Write(self._DeleteFile, fname)
+
+    def _DeleteFile(self, c, fname):
+
+        fid = self._GetFileInfo(c, fname)[0]
+        if not fid:
+            return None
+
+        c.execute("""select nid, cid, count(*) from block where fid=? group by nid, cid""", (fid,))
+        chunks = c.fetchall()
+        c.execute("""delete from block where fid=?""", (fid,))
+        c.execute("""delete from inode where fid=?""", (fid,))
+
+        # Drop the references of the file to every chunk, and queue the
+        # chunks no block uses any more
+        c.executemany("""update chunk set refs = refs - ? where nid=? and cid=?""",
+                      [(refs, nid, cid) for nid, cid, refs in chunks])
+        queued = []
+        for nid, cid, _ in chunks:
+            c.execute("""select 1 from block where nid=? and cid=? limit 1""", (nid, cid))
+            if c.fetchone() is None:
+                queued.append((nid, cid))
+        c.executemany("""delete from chunk where nid=? and cid=?""", queued)
+        now = time.time()
+        c.executemany("""insert or ignore into deleteq (nid, cid, queued) values (?, ?, ?)""",
+                      [(nid, cid, now) for nid, cid in queued])
+        return len(queued)
+
+    def TakeDeletes(self, address, port, limit):
+        """Returns up to limit chunk ids the data node (address, port) has
+            to remove, queued at least DELETE_DELAY seconds ago, and the
+            seconds since the first of them was queued.  Only copies stored
+            before then are to be removed.  They stay in the queue until
+            the data node acknowledges them.
+        """
+
+        with self._Reader() as c:
+            nid = self._CheckNode(c, address, port)
+            if not nid:
+                return [], 0
+            now = time.time()
+            c.execute("""select cid, queued from deleteq where nid=? and queued<? limit ?""",
+                      (nid, now - DELETE_DELAY, limit))
+            rows = c.fetchall()
+        if not rows:
+            return [], 0
+        return [cid for cid, _ in rows], now - min(queued for _, queued in rows)
+
+    def AckDeletes(self, address, port, cids):
+        """Removes from the deletion queue the chunks the data node
+            (address, port) removed.
+        """
+
+        return self._Write(self._AckDeletes, address, port, cids)
+
+    def _AckDeletes(self, c, address, port, cids):
+
+        nid = self._CheckNode(c, address, port)
+        if nid:
+            c.executemany("""delete from deleteq where nid=? and cid=?""",
+                          [(nid, cid) for cid in cids])
         return 1
 
+    def FindOrphans(self, address, port, blockids):
+        """Returns the blocks, of the ones a data node (address, port)
+            reports holding, that no file uses and are not waiting in the
+            deletion queue, and the seconds since the oldest upload still
+            running started, None if there is none.  Blocks stored after
+            then may belong to it.  Returns None, None if the node is not
+            registered.
+        """
+
+        with self._Reader() as c:
+            nid = self._CheckNode(c, address, port)
+            if not nid:
+                return None, None
+            c.execute("""select distinct cid from block where nid=?""", (nid,))
+            used = {cid for (cid,) in c.fetchall()}
+            c.execute("""select cid from deleteq where nid=?""", (nid,))
+            used.update(cid for (cid,) in c.fetchall())
+
+            # Files whose blocks are not added yet
+            now = time.time()
+            c.execute("""select min(created) from inode where created>=? and fsize>0 and not exists (select 1 from block where block.fid=inode.fid)""",
+                      (now - UPLOAD_TIMEOUT,))
+            oldest = c.fetchone()[0]
+        age = now - oldest if oldest is not None else None
+        return [blockid for blockid in blockids if blockid not in used], age
+
     def GetFileInode(self, fname):
         """Knowing the file name this function return the whole Inode information
-            I.E. Attributes and the list of data blocks with all the information to access 
+            I.E. Attributes and the list of data blocks with all the information to access
             the blocks (node name, address, port, and the chunk of the file).
+            Every replica of a block is listed, next to each other.
         """
 
-        fid, fsize = self.GetFileInfo(fname)
-        if not fid:
-            return None, None
-        query = f"""select address, port, cid from dnode, block where dnode.nid = block.nid and block.fid={fid}"""
-        self.c.execute(query)
-        return fsize, self.c.fetchall()
+        with self._Reader() as c:
+            fid, fsize = self._GetFileInfo(c, fname)
+            if not fid:
+                return None, None
+            query = """select address, port, cid, boffset, blen from block, dnode where block.fid=? and dnode.nid = block.nid order by block.seq"""
+            c.execute(query, (fid,))
+            return fsize, c.fetchall()
+
+    def GetFileRange(self, fname, offset, length):
+        """Like GetFileInode, but only returns the blocks that hold the bytes
+            [offset, offset + length) of the file.  The first block is found
+            through the (fid, boffset) index and the rest are read in order
+            through the (fid, seq) index.
+        """
+
+        with self._Reader() as c:
+            fid, fsize = self._GetFileInfo(c, fname)
+            if not fid:
+                return None, None
+
+            query = """select seq from block where fid=? and boffset<=? order by boffset desc limit 1"""
+            c.execute(query, (fid, offset))
+            first = c.fetchone()
+            if not first:
+                return fsize, []
+
+            query = """select address, port, cid, boffset, blen from block, dnode where block.fid=? and block.seq>=? and block.boffset<? and dnode.nid = block.nid order by block.seq"""
+            c.execute(query, (fid, first[0], offset + length))
+            return fsize, c.fetchall()
@@ -9,19 +9,52 @@
 #
 # Please modify globals with appropiate info.
 
-from mds_db import mds_db
-from Packet import Packet
-from sys import argv, getsizeof
+from mds_db import mds_db, SplitPath
+from inode_cache import InodeCache, InodeEntry, CACHE_SIZE
+from node_monitor import NodeMonitor
+from block_codec import CODECS
+from Packet import Packet, recvall, EncodeBlockIDs, DecodeBlockIDs
+from metrics import CountingSocket, getLogger
+import tracing
+from sys import argv
 import socketserver
 
+# Cluster wide block size for files that do not ask for one, and the range
+# of block sizes a client may ask for
+DEFAULT_BLOCK_SIZE = 16384
+MIN_BLOCK_SIZE = 4096
+MAX_BLOCK_SIZE = 1 << 30
+
+# Cluster wide replication factor for files that do not ask for one
+DEFAULT_REPLICATION = 1
+
+# Compression of the files that do not ask for one
+DEFAULT_CODEC = "none"
+
+# Most entries in one page of a directory listing
+LIST_PAGE = 1000
+
+# Most blocks a data node is told to remove in one heartbeat
+DELETE_BATCH = 1000
+
+
+log = getLogger("meta-data")
+
 
 def usage():
-    print(f"Usage: python {argv[0]} <port, default=8000>")
+    print(f"Usage: python {argv[0]} <port, default=8000> <default block size, default={DEFAULT_BLOCK_SIZE}> <default replication, default={DEFAULT_REPLICATION}> <inode cache bytes, default={CACHE_SIZE}>")
     exit(0)
 
 
 class MetadataTCPHandler(socketserver.BaseRequestHandler):
 
+    def send_status(self, status):
+        """Sends a status response (ACK, NAK, DUP, NFOUND) to the client"""
+
+        p = Packet()
+        p.BuildStatusPacket(status)
+        p.SendPacket(self.request)
+
     def handle_reg(self, db, p):
         """Register a new client to the DFS "ACK" if successfully REGISTERED
             "NAK" if problem, "DUP" if the IP and port already registered
@@ -31,133 +64,391 @@ class MetadataTCPHandler(socketserver.BaseRequestHandler):
         # and raises an exeption on any other error
         try:
             if db.AddDataNode(p.getAddr(), p.getPort()):
-                self.request.sendall(b"ACK")
+                self.send_status("ACK")
             else:
-                self.request.sendall(b"DUP")
+                self.send_status("DUP")
+        except:
+            self.send_status("NAK")
+
+    def handle_heartbeat(self, db, p):
+        """Record the load a data node reports in its heartbeat, take the
+            blocks it removed off the deletion queue and answer with the
+            next ones it has to remove.
+        """
+
+        address, port = p.getAddr(), p.getPort()
+        self.server.monitor.Heartbeat(address, port, *p.getLoad())
+
+        removed = DecodeBlockIDs(recvall(self.request, p.datalen))
+        try:
+            if removed:
+                db.AckDeletes(address, port, removed)
+            delete, age = db.TakeDeletes(address, port, DELETE_BATCH)
+        except:
+            delete, age = [], 0
+
+        p.BuildHeartbeatResponse(age)
+        p.SendPacket(self.request, EncodeBlockIDs(delete))
+
+    def handle_report(self, db, p):
+        """Reconcile the block report a data node sends when it starts with
+            the block table, and answer how many blocks it lost and how
+            many it holds that no file uses.
+        """
+
+        blockids = DecodeBlockIDs(recvall(self.request, p.datalen))
+
+        # Periodic checks of a running data node only look for the blocks
+        # no file uses, and send their ids back for it to collect, along
+        # with the age of the oldest upload running, whose blocks are not
+        # to be collected
+        if p.getOrphanCheck():
+            try:
+                orphans, age = db.FindOrphans(p.getAddr(), p.getPort(), blockids)
+            except:
+                orphans = None
+            if orphans is None:
+                self.send_status("NAK")
+                return
+            p.BuildBlockReportResponse("ACK", 0, len(orphans), age)
+            p.SendPacket(self.request, EncodeBlockIDs(orphans))
+            return
+
+        try:
+            result = db.ReconcileBlocks(p.getAddr(), p.getPort(), blockids)
         except:
-            self.request.sendall(b"NAK")
+            result = None
+
+        if result is None:
+            self.send_status("NAK")
+            return
+
+        lost, orphans, fnames = result
+        for fname in fnames:
+            self.server.cache.Invalidate(fname)
+
+        p.BuildBlockReportResponse("ACK", lost, orphans)
+        p.SendPacket(self.request)
 
-    def handle_list(self, db):
-        """Get the file list from the database and send list to client"""
+    def handle_rm(self, db, p):
+        """Remove a file and its blocks.  "ACK" once it is gone, "NFOUND"
+            if it does not exist.  Its blocks are removed from the data
+            nodes later, through the deletion queue.
+        """
+
+        fname = p.getFileName()
         try:
-            # Create packet
-            p = Packet()
+            result = db.DeleteFile(fname)
+        except:
+            self.send_status("NAK")
+            return
+
+        self.server.cache.Invalidate(fname)
+        if result is None:
+            self.send_status("NFOUND")
+        else:
+            self.send_status("ACK")
 
-            # Get list of tuples (fname, fsize) and insert into packet
-            file_list = db.GetFiles()
-            p.BuildListResponse(file_list)
+    def handle_chunks(self, db, p):
+        """Tell a client which of the chunks it is about to upload are
+            already stored on a live data node, so it can reference them
+            instead of sending them again.
+        """
+
+        cids = DecodeBlockIDs(recvall(self.request, p.datalen))
+        try:
+            found = [chunk for chunk in db.FindChunks(cids)
+                     if self.server.monitor.IsAlive(chunk[0], chunk[1])]
+        except:
+            self.send_status("NAK")
+            return
+
+        p.BuildChunkQueryResponse(found)
+        p.SendPacket(self.request)
+
+    def handle_bad(self, db, p):
+        """A data node found a corrupt block.  Send it the live data nodes
+            that keep another replica of the block, to repair it from.
+        """
+
+        node = (p.getAddr(), p.getPort())
+        try:
+            sources = [(address, port) for address, port, _, _, _
+                       in db.FindChunks([p.getBlockID()])
+                       if (address, port) != node
+                       and self.server.monitor.IsAlive(address, port)]
+        except:
+            self.send_status("NAK")
+            return
+
+        p.BuildRepairResponse(sources)
+        p.SendPacket(self.request)
+
+    def handle_list(self, db, p):
+        """Get one page of the listing of a directory from the database and
+            send it to client, "NFOUND" if there is no such directory
+        """
+        try:
+            # Get the subdirectories and the list of tuples (fname, fsize)
+            # of the page and insert them into packet
+            path, pattern, cursor = p.getListArgs()
+            page = db.ListDir(path, pattern, cursor, LIST_PAGE)
+            if page is None:
+                self.send_status("NFOUND")
+                return
+
+            dirs, file_list, cursor = page
+            p.BuildListResponse(file_list, dirs, cursor)
 
             # Send the encoded packet
-            self.request.send(p.getEncodedPacket())
+            p.SendPacket(self.request)
         except:
-            self.request.sendall(b"NAK")
+            self.send_status("NAK")
 
     def handle_put(self, db, p):
         """Insert new file into the database and send data nodes to save
             the file.
         """
 
-        # Get file info
+        # Get file info, and the block size the client asked for kept
+        # inside the allowed range
         info = p.getFileInfo()
-        # Get list of active data nodes and send them to cop client
-        if nodes := db.GetDataNodes():
-            if db.InsertFile(info[0], info[1]):
-                # If file was inserted properly, send back list of data nodes
-                p.BuildPutResponse(nodes)
-                self.request.sendall(p.getEncodedPacket())
+        bsize = p.getBlockSize() or DEFAULT_BLOCK_SIZE
+
+        # A file needs a name, "/" is the root directory
+        if not SplitPath(info[0]):
+            self.send_status("NAK")
+            return
+        bsize = min(max(bsize, MIN_BLOCK_SIZE), MAX_BLOCK_SIZE)
+
+        # Get the placement plan over the live data nodes, weighted by
+        # free space, speed and load, and send it to cop client
+        if nodes := self.server.monitor.GetPlacement(db.GetDataNodes()):
+            # No more replicas than live data nodes
+            repl = p.getReplication() or DEFAULT_REPLICATION
+            repl = min(max(repl, 1), len(nodes))
+
+            # Unknown codecs are not compressed
+            codec = p.getCodec() or DEFAULT_CODEC
+            if codec not in CODECS:
+                codec = "none"
+
+            if db.InsertFile(info[0], info[1], bsize, repl, codec):
+                self.server.cache.Invalidate(info[0])
+
+                # If file was inserted properly, send back the placement
+                # plan, the block size, replication factor and codec to use
+                p.BuildPutResponse(nodes, bsize, repl, codec)
+                p.SendPacket(self.request)
             else:
-                # If file was already in server, return Duplicate Error
-                self.request.sendall(b"DUP")
+                # If the file, or a directory, was already in server,
+                # return Duplicate Error
+                self.send_status("DUP")
         else:
-            # If no data nodes have registered yet, return Server Error
-            self.request.sendall(b"NAK")
+            # If no data nodes are registered and alive, return Server Error
+            self.send_status("NAK")
 
     def handle_get(self, db, p):
         """Check if file is in database and return list of
                 server nodes that contain the file.
         """
 
-        # Get filesize and chuck list from database
-        fsize, chunks = db.GetFileInode(p.getFileName())
-
-        if fsize:
-            # If file is in database, send back the chunk list
+        # Look for the file block map in the inode cache first
+        fname = p.getFileName()
+        rng = p.getRange()
+        cache = self.server.cache
+        entry = cache.Get(fname)
+
+        if entry is None and rng:
+            # Only the chunks covering the requested range, through the
+            # block offset index, without loading the whole block map
+            fsize, chunks = db.GetFileRange(fname, *rng)
+            if fsize is None:
+                self.send_status("NFOUND")
+                return
             p.BuildGetResponse(chunks, fsize)
-            self.request.sendall(p.getEncodedPacket())
+            p.SendPacket(self.request)
+            return
+
+        if entry is None:
+            version = cache.version
+            fsize, chunks = db.GetFileInode(fname)
+            if fsize is None:
+                # If file not in database, return NOT FOUND
+                self.send_status("NFOUND")
+                return
+
+            # Keep the block map and the encoded response in the cache
+            p.BuildGetResponse(chunks, fsize)
+            entry = InodeEntry(fsize, chunks, p.getFrame())
+            cache.Put(fname, entry, version)
+
+        if rng:
+            # Only the chunks covering the requested range
+            p.BuildGetResponse(entry.getRange(*rng), entry.fsize)
+            p.SendPacket(self.request)
         else:
-            # If file not in database, return NOT FOUND
-            self.request.sendall(b"NFOUND")
+            # Send back the whole chunk list, already encoded
+            self.request.sendall(entry.frame)
 
     def handle_blocks(self, db, p):
-        """Add the data blocks to the file inode"""
+        """Add the data blocks to the file inode.  "ACK" once they are
+            committed, "NFOUND" if the file has no inode, "NAK" if the
+            blocks could not be added, along with the chunk ids to upload
+            again if stored chunks it references were deleted.
+        """
 
-        # Add fname, fsize, to database table inode
-        db.AddBlockToInode(p.getFileName(), p.getDataBlocks())
+        # Add the blocks to database table block, all or nothing
+        result = db.AddBlockToInode(p.getFileName(), p.getDataBlocks(),
+                                    p.getChecksums(), p.getReferences())
+        self.server.cache.Invalidate(p.getFileName())
+        if isinstance(result, list):
+            p.BuildGoneResponse(result)
+            p.SendPacket(self.request)
+        elif result:
+            self.send_status("ACK")
+        elif result is None:
+            self.send_status("NFOUND")
+        else:
+            self.send_status("NAK")
 
-    def handle(self):
+    def handle_stats(self):
+        """Send back the metrics of the server, with the size of the inode
+            cache and the number of live data nodes.
+        """
 
-        # Establish a connection with the local database
-        db = mds_db("dfs.db")
-        db.Connect()
+        stats = self.server.metrics.snapshot()
+        cache = self.server.cache
+        stats["gauges"]["cache.entries"] = len(cache.entries)
+        stats["gauges"]["cache.bytes"] = cache.size
+        stats["gauges"]["nodes.live"] = sum(
+            self.server.monitor.IsAlive(address, port)
+            for address, port in self.server.db.GetDataNodes())
 
-        # Define a packet object to decode packet messages
         p = Packet()
+        p.BuildStatsResponse(stats)
+        p.SendPacket(self.request)
 
-        # Receive a msg from the list, data-node, or copy clients
-        msg = b""
-        while True:
-            buffer = self.request.recv(2048)
-            msg += buffer
-            if getsizeof(buffer) < 2048:
-                break
-        print(msg, type(msg))
-
-        # Decode the packet received
-        try:
-            p.DecodePacket(msg)
-        except:
-            print("Error in recieved packet")
-
-        # Extract the command part of the received packet
-        cmd = p.getCommand()
-
-        # Invoke the proper action
-        if cmd == "reg":
-            # Registration client
-            self.handle_reg(db, p)
-
-        elif cmd == "list":
-            self.handle_list(db)
-
-        elif cmd == "put":
-            # Client asking for servers to put data
-            # Fill code
-            self.handle_put(db, p)
+    def handle(self):
 
-        elif cmd == "get":
-            # Client asking for servers to get data
-            # Fill code
-            self.handle_get(db, p)
+        # Use the database connection shared by all the server threads
+        db = self.server.db
 
-        elif cmd == "dblks":
-            # Client sending data blocks for file
-            # Fill code
-            self.handle_blocks(db, p)
+        # Define a packet object to decode packet messages
+        p = Packet()
 
-        db.Close()
+        # Count the bytes in and out of this connection while it is open
+        metrics = self.server.metrics
+        self.request = CountingSocket(self.request)
+        with metrics.connection():
+            # Serve framed packets from the list, data-node, or copy clients
+            # until the client closes the connection
+            while True:
+                try:
+                    if p.RecvPacket(self.request) is None:
+                        break
+                except:
+                    log.warning("Error in recieved packet")
+                    break
+                log.debug("Packet %s", p.packet)
+
+                # Extract the command part of the received packet
+                cmd = p.getCommand()
+
+                # Invoke the proper action, timed, counted and traced
+                with metrics.request(cmd, self.request), \
+                        tracing.join(p.getTrace(), f"meta-data {cmd}", p.timing):
+                    if cmd == "reg":
+                        # Registration client
+                        self.handle_reg(db, p)
+
+                    elif cmd == "hbeat":
+                        # Data node reporting it is alive and its load
+                        self.handle_heartbeat(db, p)
+
+                    elif cmd == "brep":
+                        # Data node reporting the blocks it holds
+                        self.handle_report(db, p)
+
+                    elif cmd == "bad":
+                        # Data node reporting a corrupt block
+                        self.handle_bad(db, p)
+
+                    elif cmd == "list":
+                        self.handle_list(db, p)
+
+                    elif cmd == "put":
+                        # Client asking for servers to put data
+                        self.handle_put(db, p)
+
+                    elif cmd == "get":
+                        # Client asking for servers to get data
+                        self.handle_get(db, p)
+
+                    elif cmd == "chunks":
+                        # Client asking which blocks it does not need to upload
+                        self.handle_chunks(db, p)
+
+                    elif cmd == "dblks":
+                        # Client sending data blocks for file
+                        self.handle_blocks(db, p)
+
+                    elif cmd == "rm":
+                        # Client removing a file
+                        self.handle_rm(db, p)
+
+                    elif cmd == "stats":
+                        # Client asking for the metrics of the server
+                        self.handle_stats()
+
+
+class MetadataServer(socketserver.ThreadingTCPServer):
+    """Metadata server that handles every connection in its own thread.
+        All the threads share one mds_db, one inode cache of at most
+        cache_size bytes and the data node monitor.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, address, db, cache_size=CACHE_SIZE):
+        self.db = db
+        self.cache = InodeCache(cache_size)
+        self.monitor = NodeMonitor()
+
+        # Metrics of the server, database query times included
+        self.metrics = db.metrics
+        super().__init__(address, MetadataTCPHandler)
 
 
 if __name__ == "__main__":
     HOST, PORT = "", 8000
+    cache_size = CACHE_SIZE
 
     if len(argv) > 1:
         try:
             PORT = int(argv[1])
+            if len(argv) > 2:
+                DEFAULT_BLOCK_SIZE = int(argv[2])
+            if len(argv) > 3:
+                DEFAULT_REPLICATION = int(argv[3])
+            if len(argv) > 4:
+                cache_size = int(argv[4])
         except:
             usage()
 
-    server = socketserver.TCPServer((HOST, PORT), MetadataTCPHandler)
+    # Open the database shared by all requests and bring it up to the
+    # current schema
+    db = mds_db("dfs.db")
+    db.Connect()
+    db.Migrate()
+
+    server = MetadataServer((HOST, PORT), db, cache_size)
 
     # Activate the server; this will keep running until you
     # interrupt the program with Ctrl-C
-    server.serve_forever()
+    try:
+        server.serve_forever()
+    finally:
+        db.Close()
@@ -0,0 +1,220 @@
+###############################################################################
+#
+# Filename: metrics.py
+# Author: Jose R. Ortiz and Daniel Suazo
+#
+# Description:
+# 	Metrics and logging of the DFS servers.  Every server keeps counters,
+# 	gauges and latency histograms in memory, cheap enough to update on
+# 	every request, and sends a snapshot of them to the stats client.
+# 	Server logs are leveled, and debug messages, like the packets
+# 	received, are sampled so they can be left on under load.
+#
+
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+import logging
+import os
+import threading
+import time
+
+import tracing
+
+# Upper bounds, in seconds, of the latency histogram buckets: powers of
+# two from 1 microsecond to over 2 minutes
+BUCKETS = [2 ** i / 1e6 for i in range(28)]
+
+# Level of the server logs, and one in LOG_SAMPLE debug messages of every
+# kind is written
+LOG_LEVEL = os.environ.get("DFS_LOG", "INFO").upper()
+LOG_SAMPLE = max(1, int(os.environ.get("DFS_LOG_SAMPLE", "100")))
+
+
+class Histogram:
+    """Latency histogram with power of two buckets"""
+
+    __slots__ = ("counts", "count", "total", "max")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q):
+        """Returns the upper bound of the bucket holding the q quantile
+            (0 to 1), at most the largest value seen.
+        """
+
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if n and seen >= rank:
+                return min(BUCKETS[i] if i < len(BUCKETS) else self.max, self.max)
+        return 0.0
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "sum_ms": round(self.total * 1000, 3),
+            "p50_ms": round(self.quantile(0.5) * 1000, 3),
+            "p99_ms": round(self.quantile(0.99) * 1000, 3),
+            "max_ms": round(self.max * 1000, 3),
+        }
+
+
+class Metrics:
+    """Counters, gauges and latency histograms of a server, shared by all
+        its threads.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.counters = defaultdict(int)
+        self.gauges = defaultdict(int)
+        self.histograms = defaultdict(Histogram)
+
+    def count(self, name, n=1):
+        """Adds n to the counter name"""
+
+        with self.lock:
+            self.counters[name] += n
+
+    def observe(self, name, seconds):
+        """Adds a latency to the histogram name"""
+
+        with self.lock:
+            self.histograms[name].observe(seconds)
+
+    @contextmanager
+    def timer(self, name):
+        """Adds the time the with block takes to the histogram name, and
+            traces it as a span of the same name.
+        """
+
+        start = time.perf_counter()
+        try:
+            with tracing.span(name):
+                yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    @contextmanager
+    def connection(self):
+        """Counts a client connection as active while it is served"""
+
+        with self.lock:
+            self.gauges["connections.active"] += 1
+            self.counters["connections"] += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.gauges["connections.active"] -= 1
+
+    @contextmanager
+    def request(self, cmd, sock):
+        """Times the handling of a cmd request and counts it, together with
+            the bytes received and sent on sock, a CountingSocket, since
+            the previous request.
+        """
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            took = time.perf_counter() - start
+            received, sent = sock.take()
+            with self.lock:
+                self.counters[f"requests.{cmd}"] += 1
+                self.counters["bytes_in"] += received
+                self.counters["bytes_out"] += sent
+                self.histograms[f"requests.{cmd}"].observe(took)
+
+    def snapshot(self):
+        """Returns every metric, ready to be sent as JSON"""
+
+        with self.lock:
+            return {
+                "uptime_s": round(time.time() - self.start, 3),
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+                "histograms": {name: h.snapshot() for name, h in self.histograms.items()},
+            }
+
+
+class CountingSocket:
+    """Wraps a socket and counts the bytes received and sent through it.
+        Bytes sent with os.sendfile on its file descriptor are not seen.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.received = 0
+        self.sent = 0
+
+    def recv_into(self, buf, nbytes=0):
+        n = self.sock.recv_into(buf, nbytes)
+        self.received += n
+        return n
+
+    def sendall(self, data):
+        self.sock.sendall(data)
+        self.sent += len(data)
+
+    def take(self):
+        """Returns the bytes received and sent so far and starts counting
+            again.
+        """
+
+        counts = self.received, self.sent
+        self.received = self.sent = 0
+        return counts
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+class Sampler(logging.Filter):
+    """Lets every message above DEBUG through, and the first of every rate
+        DEBUG messages with the same format.
+    """
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+        self.seen = defaultdict(int)
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG:
+            return True
+        n = self.seen[record.msg]
+        self.seen[record.msg] = n + 1
+        return n % self.rate == 0
+
+
+def getLogger(name):
+    """Returns the logger of a server, writing to stderr at LOG_LEVEL with
+        DEBUG messages sampled.
+    """
+
+    logger = logging.getLogger(name)
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter(
+            "%(asctime)s %(name)s %(levelname)s %(message)s"))
+        handler.addFilter(Sampler(LOG_SAMPLE))
+        logger.addHandler(handler)
+        logger.setLevel(LOG_LEVEL)
+        logger.propagate = False
+    return logger
@@ -0,0 +1,111 @@
+###############################################################################
+#
+# Filename: node_monitor.py
+# Author: Jose R. Ortiz and Daniel Suazo
+#
+# Description:
+# 	Data node monitor for the metadata server.  Keeps the last heartbeat
+# 	of every data node (free disk space, transfers in flight and recent
+# 	throughput, from which its speed is estimated), considers dead the
+# 	nodes that stop sending them, and builds the placement plan for new
+# 	files.
+#
+
+import threading
+import time
+
+# Seconds between data node heartbeats, and silence after which a data
+# node is considered dead
+HEARTBEAT_INTERVAL = 3
+DEAD_AFTER = 3 * HEARTBEAT_INTERVAL
+
+# Nodes with less free space than this do not get new blocks
+MIN_FREE_SPACE = 256 << 20
+
+# Highest weight in a placement plan
+MAX_WEIGHT = 100
+
+# Weight of the last heartbeat in the smoothed speed of a data node
+SPEED_SMOOTHING = 0.3
+
+
+class NodeState:
+    """Last reported state of a data node"""
+
+    __slots__ = ("seen", "free", "inflight", "throughput", "speed")
+
+    def __init__(self, free=0, inflight=0, throughput=0, speed=None):
+        self.seen = time.monotonic()
+        self.free = free
+        self.inflight = inflight
+        self.throughput = throughput
+
+        # Smoothed bytes per second of one transfer, None until the node
+        # is seen busy
+        self.speed = speed
+
+
+class NodeMonitor:
+
+    def __init__(self):
+        self.nodes = {}
+        self.lock = threading.Lock()
+
+    def Heartbeat(self, address, port, free, inflight, throughput):
+        """Records a heartbeat from the data node (address, port).  While
+            it has transfers in flight, its throughput per transfer updates
+            the speed of the node.
+        """
+
+        with self.lock:
+            prev = self.nodes.get((address, port))
+            speed = prev.speed if prev is not None else None
+            if inflight and throughput:
+                sample = throughput / inflight
+                if speed is None:
+                    speed = sample
+                else:
+                    speed += SPEED_SMOOTHING * (sample - speed)
+            self.nodes[(address, port)] = NodeState(free, inflight, throughput, speed)
+
+    def IsAlive(self, address, port):
+        """True if the data node sent a heartbeat recently"""
+
+        with self.lock:
+            state = self.nodes.get((address, port))
+        return state is not None and time.monotonic() - state.seen < DEAD_AFTER
+
+    def GetState(self, address, port):
+        """Returns the last NodeState of a data node, None if unknown"""
+
+        with self.lock:
+            return self.nodes.get((address, port))
+
+    def GetPlacement(self, nodes):
+        """Given the registered data nodes [(address, port)], returns the
+            placement plan [(address, port, weight)] for a new file.  Dead
+            nodes and nodes short of disk space are left out.  The weight
+            grows with the free space of a node and with its speed relative
+            to the fastest node, and shrinks with the transfers it has in
+            flight.  Nodes not seen busy yet count as fast.
+        """
+
+        now = time.monotonic()
+        with self.lock:
+            live = [(address, port, self.nodes[(address, port)])
+                    for address, port in nodes
+                    if (address, port) in self.nodes
+                    and now - self.nodes[(address, port)].seen < DEAD_AFTER
+                    and self.nodes[(address, port)].free >= MIN_FREE_SPACE]
+
+        if not live:
+            return []
+
+        most = max(state.free for _, _, state in live)
+        fastest = max((state.speed for _, _, state in live if state.speed), default=None)
+        plan = []
+        for address, port, state in live:
+            share = state.speed / fastest if state.speed and fastest else 1
+            weight = MAX_WEIGHT * state.free / most * share / (1 + state.inflight)
+            plan.append((address, port, max(1, round(weight))))
+        return plan
@@ -0,0 +1,77 @@
+###############################################################################
+#
+# Filename: rm.py
+# Author: Jose R. Ortiz and Daniel Suazo
+#
+# Description:
+# 	Remove client for the DFS
+#
+
+import socket
+from sys import argv
+from Packet import Packet
+import tracing
+
+
+def usage():
+    print(f"Usage: python {argv[0]} <server>:<port, default=8000> <path>")
+    exit(0)
+
+
+def client(ip, port, path):
+    # Contacts the metadata server and asks it to remove a file.  Its
+    # blocks are removed from the data nodes in the background.
+
+    # Create socket and connect to meta data server
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.connect((ip, port))
+    except:
+        exit("Could not connect to Metadata Server. Exiting")
+
+    # Create and send the remove packet
+    pack = Packet()
+    pack.BuildRemovePacket(path)
+    try:
+        pack.SendPacket(sock)
+    except Exception as e:
+        exit(e)
+
+    # Recieve the response frame and decode it into pack
+    try:
+        pack.RecvPacket(sock)
+    except Exception as e:
+        # If packet not formatted properly
+        exit(e)
+
+    if pack.getStatus() == "NFOUND":
+        exit(f"No such file {path}")
+
+    if pack.getStatus() != "ACK":
+        # If Internal Server Error
+        exit("Error in returned packet")
+
+    # Close socket
+    sock.close()
+
+
+if __name__ == "__main__":
+
+    if len(argv) < 3:
+        usage()
+
+    ip = None
+    port = None
+    server = argv[1].split(":")
+    if len(server) == 1:
+        ip = server[0]
+        port = 8000
+    elif len(server) == 2:
+        ip = server[0]
+        port = int(server[1])
+
+    if not ip:
+        usage()
+
+    with tracing.start("rm", path=argv[2]):
+        client(ip, port, argv[2])
@@ -0,0 +1,112 @@
+###############################################################################
+#
+# Filename: stats.py
+# Author: Jose R. Ortiz and Daniel Suazo
+#
+# Description:
+# 	Stats client for the DFS.  Asks the metadata server or a data node for
+# 	its metrics and prints them, once or every few seconds.
+#
+
+import json
+import socket
+import time
+from sys import argv
+from Packet import Packet
+
+
+def usage():
+    print(f"Usage: python {argv[0]} [--json] <server>:<port, default=8000> <interval seconds, optional>")
+    exit(0)
+
+
+def fetch(sock):
+    # Asks the server for its metrics
+
+    p = Packet()
+    p.BuildStatsPacket()
+    p.SendPacket(sock)
+    if p.RecvPacket(sock) is None or p.getStatus() != "ACK":
+        exit("Error in returned packet")
+    return p.getStats()
+
+
+def show(stats, last=None):
+    # Prints the metrics, and the rate of every counter since the last
+    # ones if given
+
+    elapsed = stats["uptime_s"] - last["uptime_s"] if last else 0
+    print(f"uptime {stats['uptime_s']:.1f} s")
+
+    for name, value in sorted(stats["gauges"].items()):
+        print(f"  {name:24} {value:>14}")
+
+    for name, value in sorted(stats["counters"].items()):
+        line = f"  {name:24} {value:>14}"
+        if elapsed > 0:
+            rate = (value - last["counters"].get(name, 0)) / elapsed
+            line += f" {rate:>12.1f}/s"
+        print(line)
+
+    for name, h in sorted(stats["histograms"].items()):
+        print(f"  {name:24} {h['count']:>14}   p50 {h['p50_ms']:.3f} ms"
+              f"  p99 {h['p99_ms']:.3f} ms  max {h['max_ms']:.3f} ms")
+
+
+def client(ip, port, interval=None, raw=False):
+    # Contacts the server and prints its metrics, every interval seconds
+    # if given
+
+    # Create socket and connect to the server
+    try:
+        sock = socket.create_connection((ip, port))
+    except:
+        exit("Could not connect to the server. Exiting")
+
+    last = None
+    while True:
+        stats = fetch(sock)
+        if raw:
+            print(json.dumps(stats), flush=True)
+        else:
+            show(stats, last)
+        if interval is None:
+            break
+        last = stats
+        time.sleep(interval)
+
+    # Close socket
+    sock.close()
+
+
+if __name__ == "__main__":
+
+    raw = "--json" in argv
+    if raw:
+        argv.remove("--json")
+
+    if len(argv) < 2:
+        usage()
+
+    ip = None
+    port = None
+    server = argv[1].split(":")
+    if len(server) == 1:
+        ip = server[0]
+        port = 8000
+    elif len(server) == 2:
+        ip = server[0]
+        port = int(server[1])
+
+    if not ip:
+        usage()
+
+    try:
+        interval = float(argv[2]) if len(argv) > 2 else None
+    except:
+        usage()
+
+    try:
+        client(ip, port, interval, raw)
+    except KeyboardInterrupt:
+        pass
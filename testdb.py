@@ -18,6 +18,7 @@ db = mds_db("dfs.db")
 # Connect to the database
 print("Connecting to database")
 db.Connect()
+db.Migrate()
 
 # Testing how to add a new node to the metadata server.
 # Note that I used a node name, the address and the port.
@@ -52,7 +53,7 @@ print("Adding blocks to the file, duplicate message if not the first time runnin
 print("this script")
 try:
     db.AddBlockToInode(
-        "/hola/cheo.txt", [("what", 80, uuid1()), ("136.145.54.11", 80, uuid1())])
+        "/hola/cheo.txt", [("what", 80, uuid1(), 0, 16), ("136.145.54.11", 80, uuid1(), 16, 4)])
 except Exception as e:
     print(e)
     print("Won't duplicate")
@@ -63,8 +64,14 @@ fsize, chunks_info = db.GetFileInode("/hola/cheo.txt")
 
 print("File Size is:", fsize)
 print("and can be constructed from: ")
-for address, port, chunk in chunks_info:
-    print(address, port, chunk)
+for address, port, chunk, offset, length in chunks_info:
+    print(address, port, chunk, offset, length)
+print()
+
+print("Testing retreiving the blocks that hold bytes 18 and 19")
+fsize, chunks_info = db.GetFileRange("/hola/cheo.txt", 18, 2)
+for address, port, chunk, offset, length in chunks_info:
+    print(address, port, chunk, offset, length)
 print()
 
 print("Closing connection")
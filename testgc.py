@@ -0,0 +1,93 @@
+###############################################################################
+#
+# Filename: testgc.py
+# Author: Jose R. Ortiz and Daniel Suazo
+#
+# Description:
+#       Script to test that removing the blocks of deleted files never
+#       removes a block stored again after the file was deleted, and that
+#       collecting the blocks no file uses leaves alone the blocks of
+#       uploads still running.  Runs on a new database and block store in
+#       a temporary directory.
+#
+
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import mds_db
+from block_store import BlockStore
+
+work = tempfile.mkdtemp()
+here = os.path.dirname(os.path.abspath(__file__))
+
+# New database, with no wait before deleted blocks are handed out
+open(os.path.join(work, "dfs.db"), "w").close()
+subprocess.run([sys.executable, os.path.join(here, "createdb.py")], cwd=work,
+               check=True, stdout=subprocess.DEVNULL)
+mds_db.DELETE_DELAY = 0
+
+db = mds_db.mds_db(os.path.join(work, "dfs.db"))
+db.Connect()
+db.AddDataNode("localhost", 1)
+os.mkdir(os.path.join(work, "d1"))
+store = BlockStore(os.path.join(work, "d1"))
+
+
+def put(blockid, data):
+    with store.writer(blockid, len(data)) as (fd, offset, _):
+        os.pwrite(fd, data, offset)
+
+
+def collect():
+    # What a data node does with the deletes of a heartbeat
+    sent = time.monotonic()
+    delete, age = db.TakeDeletes("localhost", 1, 1000)
+    for blockid in delete:
+        store.delete(blockid, sent - age)
+    db.AckDeletes("localhost", 1, delete)
+    return delete
+
+
+print("Storing /a, with a content addressed block and a unique one")
+db.InsertFile("/a", 10)
+put("hash", b"hello")
+put("uuid", b"world")
+db.AddBlockToInode("/a", [("localhost", 1, "hash", 0, 5), ("localhost", 1, "uuid", 5, 5)])
+print()
+
+print("Removing /a, and uploading its content addressed block again")
+print(db.DeleteFile("/a"), "blocks queued")
+time.sleep(0.1)
+put("hash", b"hello")
+print()
+
+print("Handing the deletes to the data node")
+print("Sent", sorted(collect()))
+assert "uuid" not in store.index, "the block of /a is still stored"
+assert "hash" in store.index, "the block stored again was removed"
+print("The block of /a is gone and the one stored again is kept")
+print()
+
+print("Storing a block no file uses, and starting an upload of /big")
+put("stale", b"stale")
+time.sleep(0.1)
+db.InsertFile("/big", 10)
+time.sleep(0.1)
+put("early", b"early")
+print()
+
+print("Collecting the blocks no file uses")
+sent = time.monotonic()
+orphans, age = db.FindOrphans("localhost", 1, store.blocks())
+print("Unused", sorted(orphans))
+for blockid in orphans:
+    store.delete(blockid, sent - age)
+assert "stale" not in store.index, "the unused block is still stored"
+assert "early" in store.index, "a block of the running upload was removed"
+print("The unused block is gone and the one of the running upload is kept")
+print()
+
+db.Close()
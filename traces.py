@@ -0,0 +1,176 @@
+###############################################################################
+#
+# Filename: traces.py
+# Author: Jose R. Ortiz and Daniel Suazo
+#
+# Description:
+# 	Merges the span logs written by the DFS clients and servers when
+# 	DFS_TRACE is set, and prints the traces found, the timeline of one
+# 	of them, or where the time goes over one or all of them.
+#
+
+import glob
+import json
+import os
+import time
+from collections import defaultdict
+from sys import argv
+
+# Width of the timeline bars, in characters
+BAR_WIDTH = 40
+
+# Keys of a span log line that are not attributes of the span
+FIELDS = {"trace", "span", "parent", "name", "proc", "start", "dur"}
+
+
+def usage():
+    print(f"""Usage: python {argv[0]} <span log directory>                 list the traces
+       python {argv[0]} <span log directory> <trace id>      timeline of a trace
+       python {argv[0]} <span log directory> --summary [trace id]  time by call path
+       python {argv[0]} <span log directory> --folded [trace id]   folded stacks, for flame graphs""")
+    exit(0)
+
+
+def load(path):
+    """Reads every span log in path and returns the spans by trace id"""
+
+    traces = defaultdict(list)
+    for fname in glob.glob(os.path.join(path, "*.spans")):
+        with open(fname) as f:
+            for line in f:
+                try:
+                    span = json.loads(line)
+                except ValueError:
+                    # Line cut short by a process that died
+                    continue
+                traces[span["trace"]].append(span)
+    return traces
+
+
+def find(traces, prefix):
+    """Returns the spans of the trace whose id starts with prefix"""
+
+    found = [tid for tid in traces if tid.startswith(prefix)]
+    if len(found) != 1:
+        exit(f"{len(found)} traces match {prefix}")
+    return traces[found[0]]
+
+
+def tree(spans):
+    """Returns the root spans and the children of every span, both in
+        start order.  Spans whose parent was not logged are roots.
+    """
+
+    ids = {span["span"] for span in spans}
+    children = defaultdict(list)
+    roots = []
+    for span in sorted(spans, key=lambda s: s["start"]):
+        if span["parent"] in ids:
+            children[span["parent"]].append(span)
+        else:
+            roots.append(span)
+    return roots, children
+
+
+def show_traces(traces):
+    # One line per trace, in start order
+    print(f"{'trace':16}  {'start':19}  {'ms':>10}  {'spans':>5}  root")
+    rows = []
+    for tid, spans in traces.items():
+        roots, _ = tree(spans)
+        root = max(roots, key=lambda s: s["dur"])
+        rows.append((root["start"], tid, root, len(spans)))
+    for start, tid, root, count in sorted(rows):
+        when = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(start))
+        print(f"{tid:16}  {when}  {root['dur'] * 1000:10.3f}  {count:5}  {root['name']}")
+
+
+def show_timeline(spans):
+    # Every span indented under its parent, with its start relative to the
+    # trace and a bar placing it in time
+    roots, children = tree(spans)
+    begin = min(span["start"] for span in spans)
+    end = max(span["start"] + span["dur"] for span in spans)
+    scale = BAR_WIDTH / (end - begin) if end > begin else 0
+
+    def show(span, depth):
+        lo = int((span["start"] - begin) * scale)
+        hi = max(lo + 1, int((span["start"] + span["dur"] - begin) * scale))
+        bar = " " * lo + "#" * (hi - lo)
+        attrs = " ".join(f"{k}={v}" for k, v in span.items() if k not in FIELDS)
+        print(f"{bar:{BAR_WIDTH}} {(span['start'] - begin) * 1000:10.3f} "
+              f"{span['dur'] * 1000:10.3f}  {span['proc']:16} "
+              f"{'  ' * depth}{span['name']} {attrs}".rstrip())
+        for child in children[span["span"]]:
+            show(child, depth + 1)
+
+    print(f"{'timeline':{BAR_WIDTH}} {'start ms':>10} {'ms':>10}  {'process':16} span")
+    for root in roots:
+        show(root, 0)
+
+
+def paths(spans):
+    """Yields (call path, duration, self time) of every span.  The call
+        path is the names from its root down to it, and its self time the
+        part of its duration not spent in its children, which may run in
+        other processes or in parallel.
+    """
+
+    roots, children = tree(spans)
+
+    def walk(span, path):
+        path = path + (span["name"],)
+        inner = sum(child["dur"] for child in children[span["span"]])
+        yield path, span["dur"], max(0.0, span["dur"] - inner)
+        for child in children[span["span"]]:
+            yield from walk(child, path)
+
+    for root in roots:
+        yield from walk(root, ())
+
+
+def show_summary(traces):
+    # Time spent in every call path over all the traces, largest self
+    # time first
+    total = defaultdict(lambda: [0, 0.0, 0.0])
+    for spans in traces:
+        for path, dur, own in paths(spans):
+            total[path][0] += 1
+            total[path][1] += dur
+            total[path][2] += own
+
+    print(f"{'count':>7} {'total ms':>12} {'self ms':>12}  path")
+    for path, (count, dur, own) in sorted(total.items(), key=lambda kv: -kv[1][2]):
+        print(f"{count:7} {dur * 1000:12.3f} {own * 1000:12.3f}  {' > '.join(path)}")
+
+
+def show_folded(traces):
+    # Self time in microseconds of every call path, in the folded stack
+    # format flame graph tools read
+    total = defaultdict(float)
+    for spans in traces:
+        for path, _, own in paths(spans):
+            total[path] += own
+    for path, own in sorted(total.items()):
+        print(f"{';'.join(name.replace(';', ',') for name in path)} {int(own * 1e6)}")
+
+
+if __name__ == "__main__":
+
+    if len(argv) < 2:
+        usage()
+
+    traces = load(argv[1])
+    if not traces:
+        exit(f"No spans in {argv[1]}")
+
+    if len(argv) == 2:
+        show_traces(traces)
+    elif argv[2] in ("--summary", "--folded"):
+        selected = [find(traces, argv[3])] if len(argv) > 3 else list(traces.values())
+        if argv[2] == "--summary":
+            show_summary(selected)
+        else:
+            show_folded(selected)
+    else:
+        show_timeline(find(traces, argv[2]))
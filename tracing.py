@@ -0,0 +1,167 @@
+###############################################################################
+#
+# Filename: tracing.py
+# Author: Jose R. Ortiz and Daniel Suazo
+#
+# Description:
+# 	Request tracing for the DFS.  A client operation starts a trace, and
+# 	every request packet sent while it runs carries the trace id and the
+# 	id of the span that sent it, so the metadata server and the data
+# 	nodes record their work under the same trace.  Every process writes
+# 	the spans it finishes, one JSON object per line, to its own span log
+# 	in the directory named by the DFS_TRACE environment variable.
+# 	Tracing is off when DFS_TRACE is not set.  traces.py merges the span
+# 	logs into per request timelines.
+#
+# 	A span log line looks like:
+#
+# 	    {"trace": ..., "span": ..., "parent": ..., "name": "db.read",
+# 	     "proc": "meta-data", "start": <epoch seconds>, "dur": <seconds>}
+#
+
+from contextlib import contextmanager, nullcontext
+import json
+import os
+import sys
+import threading
+import time
+
+# Directory of the span logs, tracing is off if not set
+TRACE_DIR = os.environ.get("DFS_TRACE")
+
+# Returned instead of a span when there is nothing to trace
+_NOOP = nullcontext()
+
+_local = threading.local()
+_lock = threading.Lock()
+_log = None
+_name = os.path.splitext(os.path.basename(sys.argv[0]))[0] or "python"
+
+
+class Span:
+    __slots__ = ("trace", "id", "parent", "name", "start", "clock", "attrs")
+
+    def __init__(self, trace, parent, name, attrs):
+        self.trace = trace
+        self.id = os.urandom(4).hex()
+        self.parent = parent
+        self.name = name
+        self.start = time.time()
+        self.clock = time.perf_counter()
+        self.attrs = attrs
+
+
+def setName(name):
+    """Sets the process name written with every span, the script name by
+        default.
+    """
+
+    global _name
+    _name = name
+
+
+def _write(trace, span, parent, name, start, dur, attrs):
+    global _log
+
+    record = {"trace": trace, "span": span, "parent": parent, "name": name,
+              "proc": _name, "start": round(start, 6), "dur": round(dur, 6)}
+    if attrs:
+        record.update(attrs)
+    line = json.dumps(record) + "\n"
+
+    with _lock:
+        if _log is None:
+            os.makedirs(TRACE_DIR, exist_ok=True)
+            _log = open(os.path.join(TRACE_DIR, f"{_name}-{os.getpid()}.spans"),
+                        "a", buffering=1)
+        _log.write(line)
+
+
+@contextmanager
+def _run(span):
+    # Makes span the current one of the thread while the with block runs,
+    # and logs it when it ends
+    prev = getattr(_local, "span", None)
+    _local.span = span
+    try:
+        yield
+    finally:
+        _local.span = prev
+        _write(span.trace, span.id, span.parent, span.name, span.start,
+               time.perf_counter() - span.clock, span.attrs)
+
+
+def context():
+    """Returns (trace id, span id) of the current span of the thread, to be
+        sent along with a request, None if nothing is traced.
+    """
+
+    span = getattr(_local, "span", None)
+    return (span.trace, span.id) if span is not None else None
+
+
+def start(name, **attrs):
+    """Starts a new trace, with a root span called name"""
+
+    if not TRACE_DIR:
+        return _NOOP
+    return _run(Span(os.urandom(8).hex(), None, name, attrs))
+
+
+def span(name, **attrs):
+    """Times the with block as a child of the current span"""
+
+    parent = getattr(_local, "span", None)
+    if parent is None:
+        return _NOOP
+    return _run(Span(parent.trace, parent.id, name, attrs))
+
+
+def join(ctx, name, received=None, **attrs):
+    """Times the with block as a child of the span ctx, the (trace id,
+        span id) received in a request.  received, if given, is (arrived,
+        read, decoded): when the request started to arrive, when all of it
+        was read and when it was decoded, logged as its recv and decode
+        spans.
+    """
+
+    if not TRACE_DIR or ctx is None:
+        return _NOOP
+
+    trace, parent = ctx
+    span = Span(trace, parent, name, attrs)
+    if received is not None:
+        arrived, read, decoded = received
+        _write(trace, os.urandom(4).hex(), span.id, "recv", arrived, read - arrived, None)
+        _write(trace, os.urandom(4).hex(), span.id, "decode", read, decoded - read, None)
+        span.start = arrived
+        span.clock -= time.time() - arrived
+    return _run(span)
+
+
+def annotate(**attrs):
+    """Adds attributes to the current span"""
+
+    span = getattr(_local, "span", None)
+    if span is not None:
+        span.attrs.update(attrs)
+
+
+def wrap(fn):
+    """Returns fn made to run under the current span of this thread, for
+        work handed to other threads.
+    """
+
+    span = getattr(_local, "span", None)
+    if span is None:
+        return fn
+
+    def run(*args, **kwargs):
+        prev = getattr(_local, "span", None)
+        _local.span = span
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _local.span = prev
+
+    return run